@@ -216,6 +216,5 @@ if __name__ == "__main__":
     llm_client = LLMClient()
     agent = Agent(**AGENTS_CONFIGS["extract_files_detail"])
     repo = Repo(repo_path=".")
-    incl_files = repo.filter_files()
-    files_paths = [path for path, incl in zip(repo.files_paths, incl_files) if incl]
+    files_paths = repo.included_files_paths
     ...
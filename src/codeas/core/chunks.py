@@ -0,0 +1,87 @@
+import ast
+import math
+from typing import Callable, Dict, List
+
+from codeas.core.tokens import get_extension
+
+# finders return the indexes of the lines starting a top-level definition
+BoundariesFinder = Callable[[str, List[str]], List[int]]
+BOUNDARIES_FINDERS: Dict[str, BoundariesFinder] = {}
+
+
+def split_content(file_path: str, content: str, num_chunks: int) -> List[str]:
+    """Split the content into about num_chunks chunks of similar sizes.
+
+    Chunks are cut between top-level definitions, only a definition longer than
+    a chunk is cut between its lines and only a line longer than a chunk, as in
+    minified files, is cut within it.
+    """
+    lines = split_lines(content)
+    if num_chunks <= 1 or not content:
+        return [content]
+    max_chars = math.ceil(len(content) / num_chunks)
+    chunks, chunk, chunk_chars = [], [], 0
+    for block in split_blocks(lines, find_boundaries(file_path, content, lines)):
+        block_chars = sum(len(line) for line in block)
+        if chunk and chunk_chars + block_chars > max_chars:
+            chunks.append("".join(chunk))
+            chunk, chunk_chars = [], 0
+        for line in block:
+            if chunk and chunk_chars + len(line) > max_chars:
+                chunks.append("".join(chunk))
+                chunk, chunk_chars = [], 0
+            while len(line) > max_chars:
+                chunks.append(line[:max_chars])
+                line = line[max_chars:]
+            chunk.append(line)
+            chunk_chars += len(line)
+    if chunk:
+        chunks.append("".join(chunk))
+    return chunks
+
+
+def split_lines(content: str) -> List[str]:
+    """Split the content after each \\n only, as ast counts lines.
+
+    Unlike str.splitlines, other line breaks such as \\x0c stay within lines.
+    """
+    lines = content.split("\n")
+    return [line + "\n" for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+
+
+def split_blocks(lines: List[str], boundaries: List[int]) -> List[List[str]]:
+    starts = sorted({0, *boundaries})
+    ends = starts[1:] + [len(lines)]
+    return [lines[start:end] for start, end in zip(starts, ends) if start < end]
+
+
+def find_boundaries(file_path: str, content: str, lines: List[str]) -> List[int]:
+    finder = BOUNDARIES_FINDERS.get(get_extension(file_path))
+    if finder is not None:
+        try:
+            return finder(content, lines)
+        except (SyntaxError, ValueError, RecursionError):
+            pass
+    return find_unindented_lines(content, lines)
+
+
+def find_unindented_lines(content: str, lines: List[str]) -> List[int]:
+    """Return the lines starting at column 0, other than closing brackets."""
+    return [
+        index
+        for index, line in enumerate(lines)
+        if line.strip() and not line[0].isspace() and line[0] not in "})]"
+    ]
+
+
+def find_python_definitions(content: str, lines: List[str]) -> List[int]:
+    boundaries = []
+    for node in ast.parse(content).body:
+        # decorators are kept with the definition they decorate
+        decorators = getattr(node, "decorator_list", [])
+        boundaries.append(min([node.lineno, *(d.lineno for d in decorators)]) - 1)
+    return boundaries
+
+
+BOUNDARIES_FINDERS[".py"] = find_python_definitions
+BOUNDARIES_FINDERS[".pyi"] = find_python_definitions
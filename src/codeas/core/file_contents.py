@@ -0,0 +1,76 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+from codeas.core.tokens_cache import FileStat, get_file_stat
+
+
+class FileContents:
+    """Shared, read-once provider of the repository files contents.
+
+    Files are memory-mapped and decoded straight from the mapping when their text
+    is first requested. Decoded texts are kept in an LRU bounded by their total
+    number of characters and reused as long as the file size and mtime match.
+    """
+
+    def __init__(self, repo_path: str, max_cached_chars: int = 128 * 1024 * 1024):
+        self.repo_path = repo_path
+        self.max_cached_chars = max_cached_chars
+        self._cache: OrderedDict[str, Tuple[FileStat, str]] = OrderedDict()
+        self._cached_chars = 0
+        self._lock = threading.Lock()
+
+    def read_text(
+        self, file_path: str, stat: Optional[FileStat] = None, cache: bool = True
+    ) -> str:
+        """Return the text of a file, only keeping it in the LRU if cache is set."""
+        abs_file_path = os.path.join(self.repo_path, file_path)
+        stat = stat or get_file_stat(abs_file_path)
+        with self._lock:
+            entry = self._cache.get(file_path)
+            if entry is not None and entry[0] == stat:
+                self._cache.move_to_end(file_path)
+                return entry[1]
+        text = read_mapped_text(abs_file_path)
+        if not cache:
+            return text
+        with self._lock:
+            self._pop(file_path)
+            if len(text) <= self.max_cached_chars:
+                self._cache[file_path] = (stat, text)
+                self._cached_chars += len(text)
+                while self._cached_chars > self.max_cached_chars:
+                    self._pop(next(iter(self._cache)))
+        return text
+
+    def invalidate(self, files_paths: Optional[Iterable[str]] = None):
+        """Drop the given files from the cache, or all of them if None."""
+        with self._lock:
+            if files_paths is None:
+                self._cache.clear()
+                self._cached_chars = 0
+                return
+            for file_path in files_paths:
+                self._pop(file_path)
+
+    def _pop(self, file_path: str):
+        entry = self._cache.pop(file_path, None)
+        if entry is not None:
+            self._cached_chars -= len(entry[1])
+
+
+def read_mapped_text(abs_file_path: str) -> str:
+    """Decode a file from a read-only mapping, with universal newlines like open."""
+    with open(abs_file_path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    text = str(view, "utf-8")
+        except ValueError:
+            # empty files can't be mapped
+            text = f.read().decode("utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
@@ -0,0 +1,151 @@
+import sys
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+NO_TOKENS = -1
+
+
+class FilesTable:
+    """Columnar table of the repository files.
+
+    Paths are interned, tokens are kept in an array('i') (NO_TOKENS for files
+    that couldn't be counted) and inclusion in a bytearray mask. Files whose
+    tokens are only estimated from their size are tracked in estimated. Columns derived
+    from them, such as the included paths or the sorted table shown in the UI,
+    are computed once per change and reused until the table changes again.
+    """
+
+    def __init__(self, files_paths: Iterable[str] = ()):
+        self.paths: List[str] = [sys.intern(path) for path in files_paths]
+        self.tokens = array("i", [NO_TOKENS]) * len(self.paths)
+        self.mask = bytearray(len(self.paths))
+        self.skipped: Dict[str, str] = {}
+        self.estimated: Set[str] = set()
+        self._index = {path: i for i, path in enumerate(self.paths)}
+        self._views = {}
+        self._mask_views = {}
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __contains__(self, file_path: str) -> bool:
+        return file_path in self._index
+
+    def set_file(
+        self,
+        file_path: str,
+        tokens: Optional[int],
+        skipped: Optional[str] = None,
+        estimated: bool = False,
+    ):
+        i = self._index.get(file_path)
+        if i is None:
+            i = len(self.paths)
+            self._index[file_path] = i
+            self.paths.append(sys.intern(file_path))
+            self.tokens.append(NO_TOKENS)
+            self.mask.append(0)
+        self.tokens[i] = NO_TOKENS if tokens is None else tokens
+        if skipped:
+            self.skipped[file_path] = skipped
+        else:
+            self.skipped.pop(file_path, None)
+        if estimated:
+            self.estimated.add(file_path)
+        else:
+            self.estimated.discard(file_path)
+        self._clear_views()
+
+    def remove_files(self, files_paths: Iterable[str]):
+        removed = {self._index[path] for path in files_paths if path in self._index}
+        if not removed:
+            return
+        kept = [i for i in range(len(self.paths)) if i not in removed]
+        self.paths = [self.paths[i] for i in kept]
+        self.tokens = array("i", (self.tokens[i] for i in kept))
+        self.mask = bytearray(self.mask[i] for i in kept)
+        self._index = {path: i for i, path in enumerate(self.paths)}
+        self.skipped = {
+            path: reason for path, reason in self.skipped.items() if path in self._index
+        }
+        self.estimated.intersection_update(self._index)
+        self._clear_views()
+
+    def get_tokens(self, file_path: str) -> Optional[int]:
+        tokens = self.tokens[self._index[file_path]]
+        return None if tokens == NO_TOKENS else tokens
+
+    def set_mask(self, mask: bytearray):
+        if mask != self.mask:
+            self.mask = mask
+            self._mask_views.clear()
+
+    @property
+    def included(self) -> List[bool]:
+        return self._mask_view("included", lambda: [bool(incl) for incl in self.mask])
+
+    @property
+    def included_paths(self) -> List[str]:
+        return self._mask_view(
+            "included_paths",
+            lambda: [path for path, incl in zip(self.paths, self.mask) if incl],
+        )
+
+    @property
+    def included_tokens(self) -> List[int]:
+        return self._mask_view(
+            "included_tokens",
+            lambda: [tokens for tokens, incl in zip(self.tokens, self.mask) if incl],
+        )
+
+    @property
+    def tokens_dict(self) -> Dict[str, Optional[int]]:
+        return self._view(
+            "tokens_dict",
+            lambda: {
+                path: None if tokens == NO_TOKENS else tokens
+                for path, tokens in zip(self.paths, self.tokens)
+            },
+        )
+
+    @property
+    def sorted_columns(self) -> Dict[str, list]:
+        """Table columns with the included files first, sorted by path."""
+        return self._mask_view("sorted_columns", self._compute_sorted_columns)
+
+    def _compute_sorted_columns(self) -> Dict[str, list]:
+        # the path order only changes with the files, so filtering is a stable
+        # partition of it rather than a new sort
+        path_order = self._view(
+            "path_order",
+            lambda: sorted(range(len(self.paths)), key=self.paths.__getitem__),
+        )
+        order = [i for i in path_order if self.mask[i]]
+        order += [i for i in path_order if not self.mask[i]]
+        return {
+            "Incl.": [bool(self.mask[i]) for i in order],
+            "Path": [self.paths[i] for i in order],
+            "Tokens": [
+                None if self.tokens[i] == NO_TOKENS else self.tokens[i] for i in order
+            ],
+            "Status": [self._get_status(self.paths[i]) for i in order],
+        }
+
+    def _get_status(self, file_path: str) -> str:
+        if file_path in self.estimated:
+            return "estimated"
+        return self.skipped.get(file_path, "")
+
+    def _view(self, name: str, compute: Callable):
+        if name not in self._views:
+            self._views[name] = compute()
+        return self._views[name]
+
+    def _mask_view(self, name: str, compute: Callable):
+        if name not in self._mask_views:
+            self._mask_views[name] = compute()
+        return self._mask_views[name]
+
+    def _clear_views(self):
+        self._views.clear()
+        self._mask_views.clear()
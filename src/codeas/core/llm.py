@@ -1,5 +1,6 @@
 import asyncio
 import logging
+from typing import Iterable
 
 from openai import AsyncOpenAI, OpenAI
 
@@ -17,6 +18,8 @@ def log_retry(retry_state):
 
 class LLMClient:
     batch_size: int = 100
+    # pipelines started at once, each holding its inputs until done
+    max_pipelines: int = 200
     max_retries: int = 5
 
     def __init__(self):
@@ -35,6 +38,14 @@ class LLMClient:
             self._client = None
 
     def run(self, messages, model="gpt-4o-mini", **kwargs) -> dict:
+        model = self._prepare_completion(model, kwargs)
+        if isinstance(messages, list):
+            return self.run_completions(messages, model, **kwargs)
+        elif isinstance(messages, dict):
+            return self.run_batch_completions(messages, model, **kwargs)
+
+    def _prepare_completion(self, model: str, kwargs: dict) -> str:
+        """sets the default completion parameters in kwargs and returns the model"""
         kwargs.setdefault("temperature", self.temperature)
         kwargs.setdefault("top_p", self.top_p)
         if not kwargs.get("response_format"):
@@ -44,11 +55,40 @@ class LLMClient:
         if model == "gpt-4o":
             model = "gpt-4o-2024-08-06"
             logging.info("Using gpt-4o-2024-08-06 model")
+        return model
+
+    def run_pipelines(self, pipeline, keys: Iterable) -> dict:
+        """runs pipeline(complete, key) concurrently for each key
+
+        complete(messages, model, **kwargs) runs a completion asynchronously, with
+        at most batch_size completions running at once across all pipelines, so
+        that each pipeline moves to its next completion as soon as it can.
+        Keys are consumed lazily, with at most max_pipelines pipelines running, so
+        that the inputs they load are only held while their requests are pending.
+        """
+        return asyncio.run(self._run_pipelines(pipeline, keys))
+
+    async def _run_pipelines(self, pipeline, keys: Iterable) -> dict:
+        semaphore = asyncio.Semaphore(self.batch_size)
+        keys = iter(keys)
+        responses = {}
+        async with AsyncOpenAI(max_retries=self.max_retries) as client:
 
-        if isinstance(messages, list):
-            return self.run_completions(messages, model, **kwargs)
-        elif isinstance(messages, dict):
-            return self.run_batch_completions(messages, model, **kwargs)
+            async def complete(messages, model="gpt-4o-mini", **kwargs):
+                model = self._prepare_completion(model, kwargs)
+                async with semaphore:
+                    return await self._run_async_completions(
+                        client, messages, model, **kwargs
+                    )
+
+            async def run_next_pipelines():
+                for key in keys:
+                    responses[key] = await pipeline(complete, key)
+
+            await asyncio.gather(
+                *(run_next_pipelines() for _ in range(self.max_pipelines))
+            )
+            return responses
 
     def run_completions(self, messages, model="gpt-4o-mini", **kwargs) -> dict:
         """runs completions synchronously"""
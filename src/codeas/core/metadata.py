@@ -1,12 +1,38 @@
+import asyncio
 import json
+import logging
+import math
 import os
-from typing import List, Optional
+from functools import lru_cache
+from typing import AbstractSet, Callable, Dict, Iterable, List, Optional, Set
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr, TypeAdapter
+from tokencost import (
+    calculate_completion_cost,
+    calculate_cost_by_tokens,
+    calculate_prompt_cost,
+)
 
 from codeas.core.agent import Agent
+from codeas.core.chunks import split_content
 from codeas.core.llm import LLMClient
+from codeas.core.metadata_store import MetadataStore, get_store_key, get_store_path
 from codeas.core.repo import Repo
+from codeas.core.shards import (
+    ROOT_SHARD,
+    from_shard_path,
+    get_file_shard,
+    group_by_shard,
+    to_shard_path,
+)
+from codeas.core.static_analysis import (
+    StaticDetails,
+    analyze_file,
+    count_inbound_imports,
+    get_internal_modules,
+)
+from codeas.core.tokenizers import count_tokens
+from codeas.core.usage_rules import classify_file_usage
 
 
 class FileUsage(BaseModel):
@@ -20,6 +46,14 @@ class FileUsage(BaseModel):
     deployment_related: bool
 
 
+class PackedFileUsage(FileUsage):
+    path: str
+
+
+class PackedFilesUsage(BaseModel):
+    files: List[PackedFileUsage]
+
+
 class ClassDetails(BaseModel):
     name: str
     description: str
@@ -42,11 +76,99 @@ class TestingDetails(BaseModel):
     test_cases: List[str]
 
 
+class CodeDescriptions(BaseModel):
+    description: str
+    classes: List[ClassDetails]
+    relationships: List[str]
+    functionalities: List[str]
+
+
+class TestingDescriptions(BaseModel):
+    description: str
+    classes: List[str]
+    test_cases: List[str]
+
+
+class FileMetadata(BaseModel):
+    usage: FileUsage
+    description: Optional[str]
+    code_details: Optional[CodeDetails]
+    testing_details: Optional[TestingDetails]
+
+
+# tokens assumed for the response of each usage and details request, and for
+# the path header of each file or chunk sent, when estimating the cost
+USAGE_OUTPUT_TOKENS = 50
+DETAILS_OUTPUT_TOKENS = 500
+FILE_HEADER_TOKENS = 20
+# tokens of the messages formatting in each request
+PROMPT_OVERHEAD_TOKENS = 10
+# files up to PACKED_FILE_MAX_TOKENS are classified together in requests of up
+# to pack_max_tokens, PACK_MAX_TOKENS by default
+PACKED_FILE_MAX_TOKENS = 1000
+PACK_MAX_TOKENS = 8000
+# files over CHUNK_MAX_TOKENS have their details extracted by chunks of this size
+CHUNK_MAX_TOKENS = 16000
+# files whose usage is inferred locally with at least min_usage_confidence skip the
+# usage agent, MIN_USAGE_CONFIDENCE being the default
+MIN_USAGE_CONFIDENCE = 0.8
+# type of the values of each metadata field, keyed by file path
+METADATA_FIELDS = {
+    "files_usage": FileUsage,
+    "descriptions": str,
+    "code_details": CodeDetails,
+    "testing_details": TestingDetails,
+    "files_hashes": str,
+}
+METADATA_ADAPTERS = {
+    field: TypeAdapter(value_type) for field, value_type in METADATA_FIELDS.items()
+}
+
+
+class MetadataSettings(BaseModel):
+    """Options of the metadata generation, all disabled by default."""
+
+    # the usage of the small files is identified in requests packing several of
+    # them up to this many tokens
+    pack_max_tokens: Optional[int] = None
+    # the usage and description or details of each file come from one request
+    combine_details: bool = False
+    # the usage of the files inferred locally with at least this confidence isn't
+    # requested to the agents
+    min_usage_confidence: Optional[float] = None
+    # files sent first, the others being sent by number of files importing them
+    priority_files_paths: Optional[list[str]] = None
+    # no more files are sent once the cost spent and estimated would exceed it
+    max_cost: Optional[float] = None
+    # called with the number of files done and in total
+    progress_callback: Optional[Callable[[int, int], None]] = Field(
+        default=None, exclude=True
+    )
+
+
+class MetadataPreview(BaseModel):
+    tokens: dict
+    cost: dict
+    # files whose metadata would be generated within the cost budget
+    files_paths: list[str]
+
+
 class RepoMetadata(BaseModel):
+    """Metadata of the repository files, generated by the metadata agents.
+
+    When loaded from the stores of the shards, the metadata of a file is only read
+    when first requested, and only the files changed since are saved on export.
+    """
+
     files_usage: dict[str, FileUsage] = Field(default={})
     descriptions: dict[str, str] = Field(default={})
     code_details: dict[str, CodeDetails] = Field(default={})
     testing_details: dict[str, TestingDetails] = Field(default={})
+    # content hash of the files when their metadata was generated
+    files_hashes: dict[str, str] = Field(default={})
+    _stores: Dict[str, MetadataStore] = PrivateAttr(default_factory=dict)
+    # files whose metadata in memory replaces the one in the stores
+    _changed: Set[str] = PrivateAttr(default_factory=set)
 
     def generate_repo_metadata(
         self,
@@ -54,15 +176,11 @@ class RepoMetadata(BaseModel):
         repo: Repo,
         files_paths: list[str],
         preview: bool = False,
+        settings: Optional[MetadataSettings] = None,
     ):
-        files_usage_preview = self.generate_files_usage(
-            llm_client, repo, files_paths, preview
-        )
         if preview:
-            return files_usage_preview
-        self.generate_descriptions(llm_client, repo, files_paths)
-        self.generate_code_details(llm_client, repo, files_paths)
-        self.generate_testing_details(llm_client, repo, files_paths)
+            return self.preview_files_metadata(repo, files_paths, settings)
+        self.generate_files_metadata(llm_client, repo, files_paths, settings)
 
     def generate_missing_repo_metadata(
         self,
@@ -70,18 +188,497 @@ class RepoMetadata(BaseModel):
         repo: Repo,
         files_paths: list[str],
         preview: bool = False,
+        settings: Optional[MetadataSettings] = None,
     ):
-        missing_files_paths = [
-            file_path for file_path in files_paths if file_path not in self.files_usage
+        missing_files_paths = self.get_missing_files_paths(repo, files_paths)
+        if preview:
+            return self.preview_files_metadata(repo, missing_files_paths, settings)
+        self.generate_files_metadata(llm_client, repo, missing_files_paths, settings)
+        self.prune(repo.files_paths)
+
+    def generate_files_metadata(
+        self,
+        llm_client: LLMClient,
+        repo: Repo,
+        files_paths: list[str],
+        settings: Optional[MetadataSettings] = None,
+    ):
+        """Generate the usage, then the description or details, of each file.
+
+        Files of identical contents are only sent once, in the order and within
+        the cost of the settings. Each file is saved once its metadata is complete,
+        and the files that failed or weren't sent keep their previous metadata.
+        """
+        settings = settings or MetadataSettings()
+        files_paths = order_files_paths(repo, files_paths, settings)
+        previously_changed = self._changed.intersection(files_paths)
+        self._mark_changed(files_paths)
+        # files whose generation fails or isn't started keep their metadata
+        previous_values = {
+            file_path: {
+                field: getattr(self, field).get(file_path) for field in METADATA_FIELDS
+            }
+            for file_path in files_paths
+        }
+        files_hashes = {
+            file_path: repo.get_file_hash(file_path) for file_path in files_paths
+        }
+        for field in ("descriptions", "code_details", "testing_details"):
+            values = getattr(self, field)
+            for file_path in files_paths:
+                values.pop(file_path, None)
+        copies = self._group_copies(files_paths, files_hashes)
+        num_done_files = 0
+
+        def on_file_done(source_path: str, failed: bool):
+            nonlocal num_done_files
+            done_files_paths = copies[source_path]
+            if source_path in files_hashes:
+                done_files_paths = [source_path, *done_files_paths]
+            for file_path in done_files_paths:
+                for field in METADATA_FIELDS:
+                    if failed:
+                        value = previous_values[file_path][field]
+                    elif field != "files_hashes":
+                        value = self._get_value(field, source_path)
+                    else:
+                        value = files_hashes[file_path]
+                    if value is None:
+                        getattr(self, field).pop(file_path, None)
+                    else:
+                        getattr(self, field)[file_path] = value
+                if failed and file_path not in previously_changed:
+                    self._changed.discard(file_path)
+            if not failed:
+                self._save_files(done_files_paths)
+            num_done_files += len(done_files_paths)
+            if settings.progress_callback is not None:
+                settings.progress_callback(num_done_files, len(files_paths))
+
+        for source_path in copies:
+            if source_path not in files_hashes:
+                on_file_done(source_path, False)
+        self._run_metadata_pipelines(
+            llm_client,
+            repo,
+            [file_path for file_path in files_paths if file_path in copies],
+            settings,
+            on_file_done,
+        )
+
+    def preview_files_metadata(
+        self,
+        repo: Repo,
+        files_paths: list[str],
+        settings: Optional[MetadataSettings] = None,
+    ) -> MetadataPreview:
+        """Estimate the tokens and cost of generate_files_metadata with the settings.
+
+        The requests are planned as in the generation, without sending any.
+        """
+        settings = settings or MetadataSettings()
+        files_paths = order_files_paths(repo, files_paths, settings)
+        files_hashes = {
+            file_path: repo.get_file_hash(file_path) for file_path in files_paths
+        }
+        copies = self._group_copies(files_paths, files_hashes)
+        agents = get_metadata_agents()
+        estimate = {"input_tokens": 0, "output_tokens": 0, "cost": 0.0}
+        previewed_files_paths = [
+            file_path
+            for source_path, copies_paths in copies.items()
+            if source_path not in files_hashes
+            for file_path in copies_paths
         ]
-        files_usage_preview = self.generate_files_usage(
-            llm_client, repo, missing_files_paths, preview
+        for pack in plan_packs(
+            repo,
+            [file_path for file_path in files_paths if file_path in copies],
+            settings,
+        ):
+            if settings.max_cost is not None:
+                # the budget is checked as in the generation, before classifying
+                if (
+                    estimate["cost"]
+                    + estimate_pack_requests(repo, pack, {}, settings, agents)["cost"]
+                    > settings.max_cost
+                ):
+                    break
+            files_usage = {}
+            if settings.min_usage_confidence is not None:
+                for file_path in pack:
+                    file_usage = classify_file(
+                        repo, file_path, settings.min_usage_confidence
+                    )
+                    if file_usage is not None:
+                        files_usage[file_path] = file_usage
+            pack_estimate = estimate_pack_requests(
+                repo, pack, files_usage, settings, agents
+            )
+            for key in estimate:
+                estimate[key] += pack_estimate[key]
+            for file_path in pack:
+                previewed_files_paths.extend([file_path, *copies[file_path]])
+        return MetadataPreview(
+            tokens={
+                "input_tokens": estimate["input_tokens"],
+                "output_tokens": estimate["output_tokens"],
+                "total_tokens": estimate["input_tokens"] + estimate["output_tokens"],
+            },
+            cost={"total_cost": estimate["cost"]},
+            files_paths=previewed_files_paths,
         )
-        if preview:
-            return files_usage_preview
-        self.generate_descriptions(llm_client, repo, missing_files_paths)
-        self.generate_code_details(llm_client, repo, missing_files_paths)
-        self.generate_testing_details(llm_client, repo, missing_files_paths)
+
+    def _group_copies(
+        self, files_paths: list[str], files_hashes: Dict[str, Optional[str]]
+    ) -> Dict[str, List[str]]:
+        """Group the files by the file whose metadata is copied to them.
+
+        Each file of a new content is its own source, while the others are copies
+        of the first file found with their content.
+        """
+        sources, copies = {}, {}
+        hashes_files_paths = {}
+        for file_path, file_hash in self.files_hashes.items():
+            if file_path not in files_hashes:
+                hashes_files_paths.setdefault(file_hash, []).append(file_path)
+        for file_path in files_paths:
+            content_hash = files_hashes[file_path]
+            source_path = sources.get(content_hash)
+            if source_path is None and content_hash is not None:
+                source_path = self._find_file_with_hash(
+                    content_hash,
+                    hashes_files_paths.get(content_hash, []),
+                    files_hashes.keys(),
+                )
+            if source_path is None:
+                source_path = file_path
+            if content_hash is not None:
+                sources[content_hash] = source_path
+            copies.setdefault(source_path, [])
+            if source_path != file_path:
+                copies[source_path].append(file_path)
+        return copies
+
+    def _run_metadata_pipelines(
+        self,
+        llm_client: LLMClient,
+        repo: Repo,
+        files_paths: list[str],
+        settings: MetadataSettings,
+        on_file_done: Callable[[str, bool], None],
+    ):
+        # each file moves on to its description or details as soon as its usage
+        # is known, rather than waiting for the usage of every other file
+        agents = get_metadata_agents()
+        internal_modules = get_internal_modules(repo.files_paths)
+
+        def classify_pack_file(file_path: str) -> bool:
+            if settings.min_usage_confidence is None:
+                return False
+            file_usage = classify_file(repo, file_path, settings.min_usage_confidence)
+            if file_usage is None:
+                return False
+            self.files_usage[file_path] = file_usage
+            return True
+
+        def get_chunks(file_path: str) -> List[str]:
+            # files too large for a single request are split in chunks, their
+            # usage and description coming from the first one
+            tokens = repo.get_file_tokens(file_path) or 0
+            if tokens <= CHUNK_MAX_TOKENS:
+                return [get_file_contents(repo, file_path)]
+            return get_file_chunks(
+                repo, file_path, math.ceil(tokens / CHUNK_MAX_TOKENS)
+            )
+
+        async def generate_file_metadata(complete, file_path: str):
+            chunks = get_chunks(file_path)
+            if settings.combine_details and len(chunks) == 1:
+                return await generate_combined_metadata(complete, file_path)
+            file_usage = parse_response(
+                await run_agent_async(complete, agents["files_usage"], chunks[0])
+            )
+            self.files_usage[file_path] = file_usage
+            await generate_file_details(complete, file_path, chunks)
+
+        async def generate_combined_metadata(complete, file_path: str):
+            file_metadata = parse_response(
+                await run_agent_async(
+                    complete,
+                    agents["file_metadata"],
+                    get_file_contents(repo, file_path),
+                )
+            )
+            file_usage = self.files_usage[file_path] = file_metadata.usage
+            if not file_usage.is_code:
+                details = ("descriptions", file_metadata.description)
+            elif file_usage.testing_related:
+                details = ("testing_details", file_metadata.testing_details)
+            else:
+                details = ("code_details", file_metadata.code_details)
+            field, value = details
+            if value:
+                getattr(self, field)[file_path] = value
+            else:
+                # the details matching the usage are missing from the response
+                await generate_file_details(complete, file_path)
+
+        async def generate_file_details(
+            complete, file_path: str, chunks: Optional[List[str]] = None
+        ):
+            chunks = chunks or get_chunks(file_path)
+            file_usage = self.files_usage[file_path]
+            if not file_usage.is_code:
+                response = await run_agent_async(
+                    complete, agents["descriptions"], chunks[0]
+                )
+                self.descriptions[file_path] = response["content"]
+                return
+
+            async def run_chunks_agent(agent: Agent, suffix: str = ""):
+                # the details of each chunk are extracted in parallel and merged
+                responses = await asyncio.gather(
+                    *(
+                        run_agent_async(complete, agent, chunk + suffix)
+                        for chunk in chunks
+                    )
+                )
+                return merge_chunks_details(
+                    [parse_response(response) for response in responses]
+                )
+
+            # imports and classes are extracted locally when the language is
+            # supported, leaving only the descriptive fields to the agents
+            static_details = analyze_file(
+                file_path, repo.read_file(file_path, cache=False), internal_modules
+            )
+            if static_details is None:
+                field = (
+                    "testing_details" if file_usage.testing_related else "code_details"
+                )
+                getattr(self, field)[file_path] = await run_chunks_agent(agents[field])
+                return
+            suffix = f"\n\n{format_static_details(static_details)}"
+            if file_usage.testing_related:
+                testing_descriptions = await run_chunks_agent(
+                    agents["testing_descriptions"], suffix
+                )
+                self.testing_details[file_path] = TestingDetails(
+                    **testing_descriptions.model_dump(),
+                    external_imports=static_details.external_imports,
+                    internal_imports=static_details.internal_imports,
+                )
+            else:
+                code_descriptions = await run_chunks_agent(
+                    agents["code_descriptions"], suffix
+                )
+                self.code_details[file_path] = merge_code_details(
+                    static_details, code_descriptions
+                )
+
+        async def run_file_pipeline(generate, complete, file_path: str):
+            try:
+                await generate(complete, file_path)
+            except Exception as e:
+                logging.warning("Could not generate metadata of %s: %s", file_path, e)
+                on_file_done(file_path, True)
+            else:
+                on_file_done(file_path, False)
+
+        async def generate_pack_metadata(complete, pack: tuple):
+            if settings.max_cost is None:
+                return await generate_pack_files_metadata(complete, pack)
+            try:
+                await generate_pack_files_metadata(track_cost(complete), pack)
+            finally:
+                costs["reserved"] -= estimated_costs[pack]
+
+        def track_cost(complete):
+            async def complete_with_cost(messages, model="gpt-4o-mini", **kwargs):
+                response = await complete(messages, model, **kwargs)
+                try:
+                    costs["spent"] += get_response_cost(model, messages, response)
+                except Exception as e:
+                    logging.warning("Could not calculate the response cost: %s", e)
+                return response
+
+            return complete_with_cost
+
+        def schedule_packs():
+            for pack in packs:
+                if settings.max_cost is not None:
+                    estimated_cost = estimated_costs[pack]
+                    if (
+                        costs["spent"] + costs["reserved"] + estimated_cost
+                        > settings.max_cost
+                    ):
+                        logging.info(
+                            "Metadata generation stopped at %s cost", settings.max_cost
+                        )
+                        return
+                    costs["reserved"] += estimated_cost
+                yield pack
+
+        async def generate_pack_files_metadata(complete, pack: tuple):
+            # files are classified once scheduled, so that their contents are
+            # only read while their requests are pending
+            known_files_paths = {
+                file_path for file_path in pack if classify_pack_file(file_path)
+            }
+            unknown_files_paths = [
+                file_path for file_path in pack if file_path not in known_files_paths
+            ]
+            if len(unknown_files_paths) > 1:
+                try:
+                    response = await run_agent_async(
+                        complete,
+                        agents["packed_files_usage"],
+                        "\n\n".join(
+                            get_file_contents(repo, file_path)
+                            for file_path in unknown_files_paths
+                        ),
+                    )
+                    for packed_usage in parse_response(response).files:
+                        if packed_usage.path in unknown_files_paths:
+                            self.files_usage[packed_usage.path] = FileUsage(
+                                **packed_usage.model_dump(exclude={"path"})
+                            )
+                            known_files_paths.add(packed_usage.path)
+                except Exception as e:
+                    logging.warning("Could not identify packed files usage: %s", e)
+            # files left out of the response are identified on their own
+            await asyncio.gather(
+                *(
+                    run_file_pipeline(
+                        (
+                            generate_file_details
+                            if file_path in known_files_paths
+                            else generate_file_metadata
+                        ),
+                        complete,
+                        file_path,
+                    )
+                    for file_path in pack
+                )
+            )
+
+        packs = plan_packs(repo, files_paths, settings)
+        costs = {"spent": 0.0, "reserved": 0.0}
+        # the files aren't classified yet, so the most expensive requests are
+        # reserved for each of them
+        estimated_costs = (
+            {
+                pack: estimate_pack_requests(repo, pack, {}, settings, agents)["cost"]
+                for pack in packs
+            }
+            if settings.max_cost is not None
+            else {}
+        )
+        generated_packs = llm_client.run_pipelines(
+            generate_pack_metadata, schedule_packs()
+        )
+        for pack in packs:
+            if pack not in generated_packs:
+                for file_path in pack:
+                    on_file_done(file_path, True)
+
+    def get_missing_files_paths(self, repo: Repo, files_paths: list[str]) -> list[str]:
+        """Return the files without metadata or whose content changed since.
+
+        Files with metadata but no recorded hash, generated before hashes were
+        stored, are assumed up to date and get their current hash recorded.
+        """
+        missing_files_paths = []
+        for file_path in files_paths:
+            if self.get_file_usage(file_path) is None:
+                missing_files_paths.append(file_path)
+                continue
+            content_hash = repo.get_file_hash(file_path)
+            file_hash = self.get_file_hash(file_path)
+            if file_hash is None:
+                if content_hash is not None:
+                    self._mark_changed([file_path])
+                    self.files_hashes[file_path] = content_hash
+            elif content_hash != file_hash:
+                missing_files_paths.append(file_path)
+        return missing_files_paths
+
+    def prune(self, files_paths: list[str]):
+        """Drop the metadata of the files no longer in the repository."""
+        files_paths = set(files_paths)
+        deleted_files_paths = [
+            file_path
+            for file_path in self.get_metadata_files_paths()
+            if file_path not in files_paths
+        ]
+        for field in METADATA_FIELDS:
+            values = getattr(self, field)
+            for file_path in deleted_files_paths:
+                values.pop(file_path, None)
+        self._changed.update(deleted_files_paths)
+
+    def get_metadata_files_paths(self, field: Optional[str] = None) -> list[str]:
+        """Return the files with some metadata, or with the given field."""
+        fields = [field] if field else METADATA_FIELDS
+        files_paths = set().union(*(getattr(self, field) for field in fields))
+        for shard, store in self._stores.items():
+            files_paths.update(
+                from_shard_path(file_path, shard)
+                for file_path in store.get_paths(field)
+                if from_shard_path(file_path, shard) not in self._changed
+            )
+        return sorted(files_paths)
+
+    def _find_file_with_hash(
+        self,
+        content_hash: str,
+        loaded_files_paths: List[str],
+        excluded_files_paths: AbstractSet[str],
+    ) -> Optional[str]:
+        """Return a file with metadata for the given content, if any.
+
+        The files loaded with this hash are looked for first, then the stores.
+        """
+        files_paths = list(loaded_files_paths)
+        for shard, store in self._stores.items():
+            files_paths.extend(
+                from_shard_path(file_path, shard)
+                for file_path in store.get_key_paths(content_hash)
+            )
+        for file_path in files_paths:
+            if (
+                file_path not in excluded_files_paths
+                and self.get_file_usage(file_path) is not None
+            ):
+                return file_path
+        return None
+
+    def _get_value(self, field: str, file_path: str):
+        values = getattr(self, field)
+        if file_path not in values and self._stores and file_path not in self._changed:
+            shard = get_file_shard(file_path, set(self._stores))
+            value = self._stores[shard].get(field, to_shard_path(file_path, shard))
+            if value is not None:
+                values[file_path] = METADATA_ADAPTERS[field].validate_json(value)
+        return values.get(file_path)
+
+    def _mark_changed(self, files_paths: Iterable[str]):
+        """Read the metadata of the files from the stores before it is modified."""
+        for file_path in files_paths:
+            for field in METADATA_FIELDS:
+                self._get_value(field, file_path)
+            self._changed.add(file_path)
+
+    def _load_stores(self):
+        """Read the metadata of every file from the stores."""
+        for shard, store in self._stores.items():
+            for field, shard_file_path, value in store.get_rows():
+                file_path = from_shard_path(shard_file_path, shard)
+                if field not in METADATA_FIELDS or file_path in self._changed:
+                    continue
+                values = getattr(self, field)
+                if file_path not in values:
+                    values[file_path] = METADATA_ADAPTERS[field].validate_json(value)
 
     def generate_files_usage(
         self,
@@ -91,14 +688,11 @@ class RepoMetadata(BaseModel):
         preview: bool = False,
     ):
         context = get_files_contents(repo, files_paths)
-        agent = Agent(
-            instructions=prompt_identify_file_usage,
-            model="gpt-4o-mini",
-            response_format=FileUsage,
-        )
+        agent = get_metadata_agents()["files_usage"]
         if preview:
             return agent.preview(context)
         output = agent.run(llm_client, context)
+        self._mark_changed(files_paths)
         self.files_usage.update(
             {
                 file_path: parse_response(output.response[file_path])
@@ -115,8 +709,9 @@ class RepoMetadata(BaseModel):
             if file_path in self.files_usage and not self.files_usage[file_path].is_code
         ]
         context = get_files_contents(repo, files_to_generate_descriptions)
-        agent = Agent(instructions=prompt_generate_descriptions, model="gpt-4o-mini")
+        agent = get_metadata_agents()["descriptions"]
         output = agent.run(llm_client, context)
+        self._mark_changed(files_to_generate_descriptions)
         self.descriptions.update(
             {
                 file_path: output.response[file_path]["content"]
@@ -135,12 +730,9 @@ class RepoMetadata(BaseModel):
             and not self.files_usage[file_path].testing_related
         ]
         context = get_files_contents(repo, files_to_generate_code_details)
-        agent = Agent(
-            instructions=prompt_generate_code_details,
-            model="gpt-4o-mini",
-            response_format=CodeDetails,
-        )
+        agent = get_metadata_agents()["code_details"]
         output = agent.run(llm_client, context)
+        self._mark_changed(files_to_generate_code_details)
         self.code_details.update(
             {
                 file_path: parse_response(output.response[file_path])
@@ -159,12 +751,9 @@ class RepoMetadata(BaseModel):
             and self.files_usage[file_path].testing_related
         ]
         context = get_files_contents(repo, files_to_generate_testing_details)
-        agent = Agent(
-            instructions=prompt_generate_testing_details,
-            model="gpt-4o-mini",
-            response_format=TestingDetails,
-        )
+        agent = get_metadata_agents()["testing_details"]
         output = agent.run(llm_client, context)
+        self._mark_changed(files_to_generate_testing_details)
         self.testing_details.update(
             {
                 file_path: parse_response(output.response[file_path])
@@ -181,27 +770,134 @@ class RepoMetadata(BaseModel):
         }
 
     def get_file_usage(self, file_path: str) -> FileUsage:
-        return self.files_usage.get(file_path)
+        return self._get_value("files_usage", file_path)
 
     def get_file_description(self, file_path: str) -> str:
-        return self.descriptions.get(file_path)
+        return self._get_value("descriptions", file_path)
 
     def get_code_details(self, file_path: str) -> CodeDetails:
-        return self.code_details.get(file_path)
+        return self._get_value("code_details", file_path)
 
     def get_testing_details(self, file_path: str) -> TestingDetails:
-        return self.testing_details.get(file_path)
+        return self._get_value("testing_details", file_path)
 
-    def export_metadata(self, repo_path: str):
-        """Export the metadata to a JSON file."""
-        metadata_path = os.path.join(repo_path, ".codeas", "metadata.json")
-        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
-        with open(metadata_path, "w") as f:
-            json.dump(self.model_dump(), f, indent=2)
+    def get_file_hash(self, file_path: str) -> Optional[str]:
+        return self._get_value("files_hashes", file_path)
+
+    def split(self, shards: List[str]) -> Dict[str, "RepoMetadata"]:
+        """Split the metadata by shard, with paths relative to their shard."""
+        files_paths = set().union(*(getattr(self, field) for field in METADATA_FIELDS))
+        shards_metadata = {}
+        for shard, files_paths in group_by_shard(files_paths, shards).items():
+            metadata = shards_metadata[shard] = RepoMetadata()
+            for field in METADATA_FIELDS:
+                values = getattr(self, field)
+                getattr(metadata, field).update(
+                    (to_shard_path(file_path, shard), values[file_path])
+                    for file_path in files_paths
+                    if file_path in values
+                )
+        return shards_metadata
+
+    @classmethod
+    def merge(cls, shards_metadata: Dict[str, "RepoMetadata"]) -> "RepoMetadata":
+        """Merge the metadata of shards, inner shards taking precedence."""
+        merged = cls()
+        for shard in sorted(shards_metadata):
+            for field in METADATA_FIELDS:
+                getattr(merged, field).update(
+                    (from_shard_path(file_path, shard), value)
+                    for file_path, value in getattr(
+                        shards_metadata[shard], field
+                    ).items()
+                )
+        return merged
+
+    def export_metadata(self, repo_path: str, shards: List[str] = [ROOT_SHARD]):
+        """Save the metadata of the changed files to the store of each shard.
+
+        All the metadata is rewritten when it isn't loaded from these stores yet.
+        """
+        stores_paths = {
+            shard: get_store_path(os.path.join(repo_path, shard)) for shard in shards
+        }
+        rewrite = stores_paths != {
+            shard: store.db_path for shard, store in self._stores.items()
+        }
+        if rewrite:
+            self._load_stores()
+            for store in self._stores.values():
+                store.close()
+            self._stores = {
+                shard: MetadataStore(store_path)
+                for shard, store_path in stores_paths.items()
+            }
+            files_paths = set().union(
+                *(getattr(self, field) for field in METADATA_FIELDS)
+            )
+        else:
+            files_paths = self._changed
+        self._write_stores(files_paths, clear=rewrite)
+        self._changed.clear()
+
+    def _save_files(self, files_paths: List[str]):
+        """Write the metadata of the files to the stores, if loaded from them."""
+        if self._stores:
+            self._write_stores(files_paths)
+            self._changed.difference_update(files_paths)
+
+    def _write_stores(self, files_paths: Iterable[str], clear: bool = False):
+        """Write the metadata of the files, or drop those without any."""
+        for shard, shard_files_paths in group_by_shard(
+            files_paths, self._stores
+        ).items():
+            files_keys, rows = [], {}
+            for file_path in shard_files_paths:
+                shard_file_path = to_shard_path(file_path, shard)
+                if file_path not in self.files_usage:
+                    files_keys.append((shard_file_path, None))
+                    continue
+                key = get_store_key(shard_file_path, self.files_hashes.get(file_path))
+                files_keys.append((shard_file_path, key))
+                for field in METADATA_FIELDS:
+                    values = getattr(self, field)
+                    if file_path in values:
+                        rows[key, field] = (
+                            METADATA_ADAPTERS[field]
+                            .dump_json(values[file_path])
+                            .decode()
+                        )
+            self._stores[shard].replace(
+                files_keys,
+                [(key, field, value) for (key, field), value in rows.items()],
+                clear=clear,
+            )
 
     @classmethod
-    def load_metadata(cls, repo_path: str) -> Optional["RepoMetadata"]:
-        """Load metadata from a JSON file. Returns None if the file doesn't exist."""
+    def load_metadata(
+        cls, repo_path: str, shards: List[str] = [ROOT_SHARD]
+    ) -> "RepoMetadata":
+        """Open the store of each shard, the metadata being read when requested.
+
+        Shards with only a metadata.json, exported before the stores, are read in
+        full and saved to their store on the next export.
+        """
+        metadata = cls.merge(
+            {
+                shard: cls._load_metadata_file(os.path.join(repo_path, shard))
+                for shard in shards
+                if not os.path.exists(get_store_path(os.path.join(repo_path, shard)))
+            }
+        )
+        metadata._changed.update(metadata.get_metadata_files_paths())
+        metadata._stores = {
+            shard: MetadataStore(get_store_path(os.path.join(repo_path, shard)))
+            for shard in shards
+        }
+        return metadata
+
+    @classmethod
+    def _load_metadata_file(cls, repo_path: str) -> "RepoMetadata":
         metadata_path = os.path.join(repo_path, ".codeas", "metadata.json")
         if not os.path.exists(metadata_path):
             return cls()
@@ -213,15 +909,319 @@ class RepoMetadata(BaseModel):
 def get_files_contents(repo: Repo, file_paths: list[str]) -> str:
     contents = {}
     for file_path in file_paths:
-        with open(os.path.join(repo.repo_path, file_path), "r") as f:
-            contents[file_path] = f"# path = {file_path}:\n{f.read()}"
+        contents[file_path] = get_file_contents(repo, file_path)
     return contents
 
 
+def get_file_contents(repo: Repo, file_path: str) -> str:
+    return f"# path = {file_path}:\n{repo.read_file(file_path, cache=False)}"
+
+
+def order_files_paths(
+    repo: Repo, files_paths: list[str], settings: MetadataSettings
+) -> list[str]:
+    """Order the files by priority, then by number of files importing them.
+
+    The order only matters with priority files or a cost budget, the imports
+    being counted among the files within the size limits only.
+    """
+    if len(files_paths) <= 1 or (
+        not settings.priority_files_paths and settings.max_cost is None
+    ):
+        return list(files_paths)
+    priority_files_paths = set(settings.priority_files_paths or [])
+    inbound_imports = count_inbound_imports(
+        [
+            file_path
+            for file_path in repo.files_paths
+            if repo.get_file_tokens(file_path) and file_path not in repo.files_skipped
+        ],
+        lambda file_path: repo.read_file(file_path, cache=False),
+    )
+    return sorted(
+        files_paths,
+        key=lambda file_path: (
+            file_path not in priority_files_paths,
+            -inbound_imports.get(file_path, 0),
+            file_path,
+        ),
+    )
+
+
+def plan_packs(
+    repo: Repo, files_paths: list[str], settings: MetadataSettings
+) -> List[tuple]:
+    """Group the files in packs sent together, in the order of the files."""
+    if settings.pack_max_tokens:
+        packs = pack_files(repo, files_paths, settings.pack_max_tokens)
+    else:
+        packs = [(file_path,) for file_path in files_paths]
+    ranks = {file_path: rank for rank, file_path in enumerate(files_paths)}
+    packs.sort(key=lambda pack: min(ranks[file_path] for file_path in pack))
+    return packs
+
+
+def classify_file(
+    repo: Repo, file_path: str, min_usage_confidence: float
+) -> Optional[FileUsage]:
+    """Return the usage of a file inferred locally, if confident enough."""
+    try:
+        content = repo.read_file(file_path, cache=False)
+    except (OSError, UnicodeDecodeError) as e:
+        logging.warning("Could not classify %s: %s", file_path, e)
+        return None
+    file_usage, confidence = classify_file_usage(file_path, content)
+    if confidence < min_usage_confidence:
+        return None
+    return FileUsage(**file_usage)
+
+
+def estimate_pack_requests(
+    repo: Repo,
+    pack: tuple,
+    files_usage: Dict[str, FileUsage],
+    settings: MetadataSettings,
+    agents: Dict[str, Agent],
+) -> Dict[str, float]:
+    """Estimate the tokens and cost of the requests generating a pack's metadata.
+
+    The requests are the ones of _run_metadata_pipelines, the files missing from
+    files_usage being assumed to need the most expensive details.
+    """
+    estimate = {"input_tokens": 0, "output_tokens": 0, "cost": 0.0}
+
+    def add_request(agents_names: List[str], context_tokens: int, output_tokens: int):
+        agent = max(
+            (agents[agent_name] for agent_name in agents_names),
+            key=get_prompt_tokens,
+        )
+        input_tokens = get_prompt_tokens(agent) + context_tokens
+        estimate["input_tokens"] += input_tokens
+        estimate["output_tokens"] += output_tokens
+        estimate["cost"] += float(
+            calculate_cost_by_tokens(input_tokens, agent.model, "input")
+            + calculate_cost_by_tokens(output_tokens, agent.model, "output")
+        )
+
+    def add_details_requests(file_path: str):
+        file_usage = files_usage.get(file_path)
+        if file_usage is not None and not file_usage.is_code:
+            agents_names, num_requests = ["descriptions"], 1
+        else:
+            if file_usage is None:
+                agents_names = ["descriptions", "code_details", "testing_details"]
+            elif file_usage.testing_related:
+                agents_names = ["testing_details"]
+            else:
+                agents_names = ["code_details"]
+            num_requests = num_chunks[file_path]
+        for _ in range(num_requests):
+            add_request(agents_names, chunks_tokens[file_path], DETAILS_OUTPUT_TOKENS)
+
+    files_tokens = {
+        file_path: repo.get_file_tokens(file_path) or 0 for file_path in pack
+    }
+    num_chunks = {
+        file_path: max(1, math.ceil(tokens / CHUNK_MAX_TOKENS))
+        for file_path, tokens in files_tokens.items()
+    }
+    chunks_tokens = {
+        file_path: tokens // num_chunks[file_path] + FILE_HEADER_TOKENS
+        for file_path, tokens in files_tokens.items()
+    }
+    unknown_files_paths = [
+        file_path for file_path in pack if file_path not in files_usage
+    ]
+    if len(unknown_files_paths) > 1:
+        add_request(
+            ["packed_files_usage"],
+            sum(
+                files_tokens[file_path] + FILE_HEADER_TOKENS
+                for file_path in unknown_files_paths
+            ),
+            USAGE_OUTPUT_TOKENS * len(unknown_files_paths),
+        )
+        unknown_files_paths = []
+    for file_path in pack:
+        if file_path not in unknown_files_paths:
+            add_details_requests(file_path)
+        elif settings.combine_details and num_chunks[file_path] == 1:
+            add_request(
+                ["file_metadata"],
+                chunks_tokens[file_path],
+                USAGE_OUTPUT_TOKENS + DETAILS_OUTPUT_TOKENS,
+            )
+        else:
+            add_request(["files_usage"], chunks_tokens[file_path], USAGE_OUTPUT_TOKENS)
+            add_details_requests(file_path)
+    return estimate
+
+
+def get_prompt_tokens(agent: Agent) -> int:
+    return count_prompt_tokens(agent.instructions, agent.model, agent.response_format)
+
+
+@lru_cache(maxsize=None)
+def count_prompt_tokens(
+    instructions: str, model: str, response_format: Optional[type]
+) -> int:
+    """Count the tokens sent in each request of an agent besides the context.
+
+    The schema of structured responses is sent along with the instructions.
+    """
+    schema = json.dumps(response_format.model_json_schema()) if response_format else ""
+    return count_tokens(instructions + schema, model) + PROMPT_OVERHEAD_TOKENS
+
+
+def get_response_cost(model: str, messages: list, response) -> float:
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        return float(
+            calculate_cost_by_tokens(usage.prompt_tokens, model, "input")
+            + calculate_cost_by_tokens(usage.completion_tokens, model, "output")
+        )
+    return float(
+        calculate_prompt_cost(messages, model)
+        + calculate_completion_cost(response["content"] or "", model)
+    )
+
+
+def get_file_chunks(repo: Repo, file_path: str, num_chunks: int) -> List[str]:
+    chunks = split_content(
+        file_path, repo.read_file(file_path, cache=False), num_chunks
+    )
+    return [
+        f"# path = {file_path} (part {index}/{len(chunks)}):\n{chunk}"
+        for index, chunk in enumerate(chunks, 1)
+    ]
+
+
+def merge_chunks_details(chunks_details: List[BaseModel]) -> BaseModel:
+    """Merge the details extracted from each chunk of a file.
+
+    Lists are merged without duplicates, classes by name, while the description
+    of the file is the one of its first chunk.
+    """
+    if len(chunks_details) == 1:
+        return chunks_details[0]
+    merged = {}
+    for field in type(chunks_details[0]).model_fields:
+        values = [getattr(details, field) for details in chunks_details]
+        if not isinstance(values[0], list):
+            merged[field] = values[0]
+            continue
+        items = {}
+        for value in values:
+            for item in value:
+                items.setdefault(
+                    item.name if isinstance(item, ClassDetails) else item, item
+                )
+        merged[field] = list(items.values())
+    return type(chunks_details[0])(**merged)
+
+
+def format_static_details(static_details: StaticDetails) -> str:
+    return (
+        f"# external imports: {', '.join(static_details.external_imports)}\n"
+        f"# internal imports: {', '.join(static_details.internal_imports)}\n"
+        f"# classes: {', '.join(static_details.classes)}"
+    )
+
+
+def merge_code_details(
+    static_details: StaticDetails, code_descriptions: CodeDescriptions
+) -> CodeDetails:
+    descriptions = {
+        class_details.name: class_details.description
+        for class_details in code_descriptions.classes
+    }
+    return CodeDetails(
+        description=code_descriptions.description,
+        external_imports=static_details.external_imports,
+        internal_imports=static_details.internal_imports,
+        classes=[
+            ClassDetails(name=name, description=descriptions.get(name, ""))
+            for name in static_details.classes
+        ],
+        relationships=code_descriptions.relationships,
+        functionalities=code_descriptions.functionalities,
+    )
+
+
 def parse_response(response: object):
     return response.choices[0].message.parsed
 
 
+def get_metadata_agents() -> Dict[str, Agent]:
+    return {
+        "files_usage": Agent(
+            instructions=prompt_identify_file_usage,
+            model="gpt-4o-mini",
+            response_format=FileUsage,
+        ),
+        "packed_files_usage": Agent(
+            instructions=prompt_identify_packed_files_usage,
+            model="gpt-4o-mini",
+            response_format=PackedFilesUsage,
+        ),
+        "file_metadata": Agent(
+            instructions=prompt_generate_file_metadata,
+            model="gpt-4o-mini",
+            response_format=FileMetadata,
+        ),
+        "descriptions": Agent(
+            instructions=prompt_generate_descriptions, model="gpt-4o-mini"
+        ),
+        "code_details": Agent(
+            instructions=prompt_generate_code_details,
+            model="gpt-4o-mini",
+            response_format=CodeDetails,
+        ),
+        "testing_details": Agent(
+            instructions=prompt_generate_testing_details,
+            model="gpt-4o-mini",
+            response_format=TestingDetails,
+        ),
+        "code_descriptions": Agent(
+            instructions=prompt_generate_code_descriptions,
+            model="gpt-4o-mini",
+            response_format=CodeDescriptions,
+        ),
+        "testing_descriptions": Agent(
+            instructions=prompt_generate_testing_descriptions,
+            model="gpt-4o-mini",
+            response_format=TestingDescriptions,
+        ),
+    }
+
+
+def pack_files(repo: Repo, files_paths: list[str], pack_max_tokens: int) -> List[tuple]:
+    """Group the small files, in path order, into packs of up to pack_max_tokens."""
+    packs = []
+    pack, pack_tokens = [], 0
+    for file_path in sorted(files_paths):
+        tokens = repo.get_file_tokens(file_path) or 0
+        if tokens > min(PACKED_FILE_MAX_TOKENS, pack_max_tokens):
+            packs.append((file_path,))
+            continue
+        if pack and pack_tokens + tokens > pack_max_tokens:
+            packs.append(tuple(pack))
+            pack, pack_tokens = [], 0
+        pack.append(file_path)
+        pack_tokens += tokens
+    if pack:
+        packs.append(tuple(pack))
+    return packs
+
+
+async def run_agent_async(complete, agent: Agent, context: str):
+    return await complete(
+        agent.get_single_messages(context),
+        agent.model,
+        response_format=agent.response_format,
+    )
+
+
 prompt_identify_file_usage = """
 Analyze the given file path and content to determine its usage and type. Respond with boolean values for the following properties:
 
@@ -248,6 +1248,10 @@ Programming files which only contain data, configurations, or documentation shou
 """.strip()
 
 
+prompt_identify_packed_files_usage = prompt_identify_file_usage + """
+The content of several files is given, each one preceded by its path. Respond with one entry per file, with its path exactly as given.
+"""
+
 prompt_generate_code_details = """
 Analyze the given code and provide the following details:
 1. Description: A single sentence describing what the file does.
@@ -282,11 +1286,48 @@ Be concise and focus on key information. Do not write any explanations.
 """.strip()
 
 
+prompt_generate_code_descriptions = """
+Analyze the given code and provide the following details:
+1. Description: A single sentence describing what the file does.
+2. Classes: For each class listed at the end of the file, its name and a concise description of what the class does.
+3. Relationships: Show dependencies between classes in this file and modules/classes from the internal imports listed at the end of the file. Use -> for "depends on", <- for "is depended on by", and <> for bidirectional dependencies. Avoid repeating the same relationship in multiple directions.
+4. Functionalities: List the main functionalities present in the file. DO NOT name specific methods or functions.
+
+Be concise and focus on key information. Do not write any explanations.
+""".strip()
+
+
+prompt_generate_testing_descriptions = """
+Analyze the given test file and provide the following details:
+1. Description: A single sentence describing what the test file covers.
+2. Classes: List the classes tested in this file.
+3. Test cases: List the main test cases or test groups present in the file. Use general descriptions rather than specific method names.
+
+Be concise and focus on key information. Do not write any explanations.
+""".strip()
+
+
 prompt_generate_descriptions = """
 Write a single sentence describing what the given file does.
 Add the technologies mentioned inside that file (and their versions if present) after that description.
 """
 
+
+prompt_generate_file_metadata = f"""
+{prompt_identify_file_usage}
+
+Then, depending on the usage identified, fill in one of the following and set the others to null:
+
+- description, if is_code is false:
+{prompt_generate_descriptions.strip()}
+
+- testing_details, if is_code and testing_related are true:
+{prompt_generate_testing_details}
+
+- code_details, if is_code is true and testing_related is false:
+{prompt_generate_code_details}
+""".strip()
+
 if __name__ == "__main__":
     llm_client = LLMClient()
     repo_path = "."
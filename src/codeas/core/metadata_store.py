@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+
+class MetadataStore:
+    """SQLite store of the metadata of a shard, in its .codeas/metadata.db.
+
+    Each file is linked to a key, the hash of its content, and each kind of
+    metadata of each key is a row holding its JSON value. Files with identical
+    contents thus share their rows, the metadata of a file is read with one
+    indexed lookup and saving some files leaves the rows of the others untouched.
+    The database is only created on the first write.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, file_path: str) -> Optional[str]:
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return None
+            row = conn.execute(
+                "SELECT value FROM files JOIN blobs USING (key) "
+                "WHERE path = ? AND kind = ?",
+                (file_path, kind),
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_paths(self, kind: Optional[str] = None) -> List[str]:
+        """Return the paths of the files with some metadata, or of a given kind."""
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return []
+            if kind is None:
+                rows = conn.execute("SELECT path FROM files")
+            else:
+                rows = conn.execute(
+                    "SELECT path FROM files JOIN blobs USING (key) WHERE kind = ?",
+                    (kind,),
+                )
+            return [row[0] for row in rows]
+
+    def get_key_paths(self, key: str) -> List[str]:
+        """Return the paths of the files linked to a key."""
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return []
+            rows = conn.execute("SELECT path FROM files WHERE key = ?", (key,))
+            return [row[0] for row in rows]
+
+    def get_rows(self) -> List[Tuple[str, str, str]]:
+        """Return the kind, path and value of the metadata of every file."""
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return []
+            return conn.execute(
+                "SELECT kind, path, value FROM files JOIN blobs USING (key)"
+            ).fetchall()
+
+    def replace(
+        self,
+        files_keys: Iterable[Tuple[str, Optional[str]]],
+        rows: Iterable[Tuple[str, str, str]],
+        clear: bool = False,
+    ):
+        """Link the files to their key, None to drop them, and replace the rows.
+
+        The rows, given by key, kind and value, replace every row of their keys.
+        The rows of the keys no file is linked to anymore are dropped.
+        """
+        with self._lock:
+            conn = self._connect(create=True)
+            with conn:
+                if clear:
+                    conn.execute("DELETE FROM files")
+                    conn.execute("DELETE FROM blobs")
+                old_keys = set()
+                for file_path, key in files_keys:
+                    old_key = conn.execute(
+                        "SELECT key FROM files WHERE path = ?", (file_path,)
+                    ).fetchone()
+                    if old_key is not None:
+                        old_keys.add(old_key[0])
+                    if key is None:
+                        conn.execute("DELETE FROM files WHERE path = ?", (file_path,))
+                    else:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO files (path, key) VALUES (?, ?)",
+                            (file_path, key),
+                        )
+                rows = list(rows)
+                conn.executemany(
+                    "DELETE FROM blobs WHERE key = ?",
+                    {(key,) for key, _, _ in rows},
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO blobs (key, kind, value) VALUES (?, ?, ?)",
+                    rows,
+                )
+                conn.executemany(
+                    "DELETE FROM blobs WHERE key = ? "
+                    "AND NOT EXISTS (SELECT 1 FROM files WHERE key = ?)",
+                    ((key, key) for key in old_keys),
+                )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _connect(self, create: bool = False) -> Optional[sqlite3.Connection]:
+        if self._conn is None:
+            if not create and not os.path.exists(self.db_path):
+                return None
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            with self._conn:
+                create_tables(self._conn)
+        return self._conn
+
+
+def create_tables(conn: sqlite3.Connection):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        "path TEXT PRIMARY KEY, key TEXT NOT NULL) WITHOUT ROWID"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS files_key ON files (key)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS blobs ("
+        "key TEXT NOT NULL, kind TEXT NOT NULL, value TEXT NOT NULL, "
+        "PRIMARY KEY (key, kind)) WITHOUT ROWID"
+    )
+
+
+def get_store_path(repo_path: str) -> str:
+    return os.path.join(repo_path, ".codeas", "metadata.db")
+
+
+def get_store_key(file_path: str, content_hash: Optional[str]) -> str:
+    """Return the key of a file in the store, the hash of its content if known."""
+    return content_hash if content_hash is not None else f"path:{file_path}"
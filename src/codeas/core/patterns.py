@@ -0,0 +1,152 @@
+import os
+import re
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Tuple
+
+
+def translate_glob(pattern: str, star_matches_slash: bool = False) -> str:
+    """Translate a glob pattern into a regex string.
+
+    `?` doesn't match across `/`, `**` matches any number of directories
+    and `[...]` character classes are supported (`[!...]` negates them).
+    `*` only matches across `/` if star_matches_slash is set.
+    """
+    regex = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**", i):
+            i += 2
+            if pattern.startswith("/", i):
+                regex.append("(?:.*/)?")
+                i += 1
+            else:
+                regex.append(".*")
+            continue
+        if c == "*":
+            regex.append(".*" if star_matches_slash else "[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[":
+            end = _find_class_end(pattern, i)
+            if end is None:
+                regex.append(re.escape(c))
+            else:
+                regex.append(_translate_class(pattern[i + 1 : end]))
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return "".join(regex)
+
+
+def _find_class_end(pattern: str, start: int) -> Optional[int]:
+    i = start + 1
+    if i < len(pattern) and pattern[i] in "!^":
+        i += 1
+    if i < len(pattern) and pattern[i] == "]":
+        i += 1
+    end = pattern.find("]", i)
+    return end if end != -1 else None
+
+
+def _translate_class(content: str) -> str:
+    if content[:1] in "!^":
+        content = "^" + content[1:]
+    content = content.replace("\\", "\\\\")
+    return f"[{content}]"
+
+
+class IgnoreRule(NamedTuple):
+    regex: re.Pattern
+    negate: bool
+    dir_only: bool
+    base: str
+
+
+def parse_ignore_rule(line: str, base: str = "") -> Optional[IgnoreRule]:
+    """Parse a .gitignore line into a rule relative to the `base` directory."""
+    line = line.rstrip("\n")
+    if not line.strip() or line.startswith("#"):
+        return None
+    if not line.endswith("\\ "):
+        line = line.rstrip()
+    negate = line.startswith("!")
+    if negate or line.startswith("\\!") or line.startswith("\\#"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    anchored = "/" in line
+    line = line.lstrip("/")
+    regex = translate_glob(line)
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return IgnoreRule(re.compile(regex + r"\Z"), negate, dir_only, base)
+
+
+def parse_ignore_file(path: str, base: str = "") -> List[IgnoreRule]:
+    try:
+        with open(path, "r", errors="ignore") as f:
+            rules = [parse_ignore_rule(line, base) for line in f]
+    except OSError:
+        return []
+    return [rule for rule in rules if rule is not None]
+
+
+def is_ignored(rules: List[IgnoreRule], rel_path: str, is_dir: bool) -> bool:
+    """Check a path against gitignore rules, the last matching rule winning."""
+    for rule in reversed(rules):
+        if rule.dir_only and not is_dir:
+            continue
+        if rule.base:
+            if not rel_path.startswith(rule.base + "/"):
+                continue
+            path = rel_path[len(rule.base) + 1 :]
+        else:
+            path = rel_path
+        if rule.regex.match(path):
+            return not rule.negate
+    return False
+
+
+class PathMatcher:
+    """Match paths against a list of filter patterns compiled into a single regex.
+
+    A pattern matches a path or any of its parent directories, and `*` matches
+    across directories so that `src/*` or `*.py` also match nested files.
+    """
+
+    def __init__(self, patterns: Tuple[str, ...]):
+        self.patterns = patterns
+        self.regex = (
+            re.compile(
+                "(?:"
+                + "|".join(translate_filter_pattern(pattern) for pattern in patterns)
+                + r")(?:/.*)?\Z",
+                re.DOTALL,
+            )
+            if patterns
+            else None
+        )
+
+    def match(self, path: str) -> bool:
+        if self.regex is None:
+            return False
+        if os.sep != "/":
+            path = path.replace(os.sep, "/")
+        return self.regex.match(path) is not None
+
+
+def translate_filter_pattern(pattern: str) -> str:
+    pattern = pattern.replace(os.sep, "/").rstrip("/")
+    return translate_glob(pattern, star_matches_slash=True)
+
+
+@lru_cache(maxsize=64)
+def compile_matcher(patterns: Tuple[str, ...]) -> PathMatcher:
+    return PathMatcher(patterns)
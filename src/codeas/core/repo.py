@@ -1,92 +1,445 @@
-import glob
 import os
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Literal, Optional
 
-import tokencost
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr
+
+from codeas.core.file_contents import FileContents
+from codeas.core.files_table import FilesTable
+from codeas.core.patterns import compile_matcher
+from codeas.core.shards import ROOT_SHARD, detect_shards, get_file_shard
+from codeas.core.tokenizers import get_tokenizer, get_tokenizer_name
+from codeas.core.tokens import (
+    TOKENS_MODEL,
+    calibrate_bytes_per_token,
+    count_files_tokens,
+    estimate_tokens,
+    hash_content,
+)
+from codeas.core.tokens_cache import FileStat, TokensCache, get_file_stat
+from codeas.core.walker import is_path_ignored, walk_files, walk_shards_files
+
+PROGRESS_INTERVAL = 0.1
+CACHE_CHECKPOINT_INTERVAL = 5.0
+ESTIMATE_MIN_FILES = 5000
 
 
 class Repo(BaseModel):
     repo_path: str
-    files_paths: List[str] = []
-    files_tokens: dict = {}
-    included: List[bool] = []
-    included_files_paths: List[str] = []
-    included_files_tokens: List[int] = []
+    tokens_model: str = TOKENS_MODEL
+    # "auto" estimates the tokens of repositories of at least ESTIMATE_MIN_FILES
+    tokens_mode: Literal["exact", "estimate", "auto"] = "exact"
+    tokens_workers: Optional[int] = None
+    tokens_chunk_size: int = 256
+    tokens_use_processes: bool = False
+    use_tokens_cache: bool = True
+    ignore_patterns: List[str] = []
+    include_hidden: bool = False
+    max_file_size: int = 1024 * 1024
+    max_cached_chars: int = 128 * 1024 * 1024
+    # split the repository into the sub-projects found in it, see shards.py
+    detect_shards: bool = False
+    # called with the stage ("scanning" or "counting"), the files done and the
+    # total number of files (0 while it is unknown)
+    progress_callback: Optional[Callable[[str, int, int], None]] = Field(
+        default=None, exclude=True
+    )
+    _table: FilesTable = PrivateAttr(default_factory=FilesTable)
+    _contents: FileContents = PrivateAttr(default=None)
+    _files_stats: dict = PrivateAttr(default_factory=dict)
+    _shards: List[str] = PrivateAttr(default_factory=lambda: [ROOT_SHARD])
+    _tokens_cache: TokensCache = PrivateAttr(default_factory=TokensCache)
+    _filter_args: tuple = PrivateAttr(default=([], [], None))
+    _refining: Optional[tuple] = PrivateAttr(default=None)
+    _last_progress: float = PrivateAttr(default=0.0)
+    _last_checkpoint: float = PrivateAttr(default=0.0)
+    # guards the tokens cache, also updated by the background counts
+    _cache_lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
 
     def __init__(self, **data):
         super().__init__(**data)
         self.repo_path = os.path.abspath(self.repo_path)
-        self.files_paths = self.get_files_paths()
+        self._contents = FileContents(self.repo_path, self.max_cached_chars)
+        self._table = FilesTable(self.get_files_paths())
         self.calculate_files_tokens()
         self.filter_files()
 
+    @property
+    def files_paths(self) -> List[str]:
+        return self._table.paths
+
+    @property
+    def files_tokens(self) -> Dict[str, Optional[int]]:
+        return self._table.tokens_dict
+
+    @property
+    def files_skipped(self) -> Dict[str, str]:
+        return self._table.skipped
+
+    @property
+    def included(self) -> List[bool]:
+        return self._table.included
+
+    @property
+    def included_files_paths(self) -> List[str]:
+        return self._table.included_paths
+
+    @property
+    def included_files_tokens(self) -> List[int]:
+        return self._table.included_tokens
+
+    @property
+    def files_table(self) -> FilesTable:
+        return self._table
+
+    @property
+    def shards(self) -> List[str]:
+        return self._shards
+
+    @property
+    def is_estimate_mode(self) -> bool:
+        return self.tokens_mode == "estimate" or (
+            self.tokens_mode == "auto" and len(self._table) >= ESTIMATE_MIN_FILES
+        )
+
+    @property
+    def is_estimating(self) -> bool:
+        return bool(self._table.estimated)
+
+    def get_file_tokens(self, file_path: str) -> Optional[int]:
+        return self._table.get_tokens(file_path)
+
+    def get_file_stat(self, file_path: str) -> Optional[FileStat]:
+        try:
+            return get_file_stat(os.path.join(self.repo_path, file_path))
+        except OSError:
+            return None
+
+    def get_file_hash(self, file_path: str) -> Optional[str]:
+        """Return the content hash of a file, from the tokens cache if up to date."""
+        abs_file_path = os.path.join(self.repo_path, file_path)
+        try:
+            stat = get_file_stat(abs_file_path)
+            entry = self._tokens_cache.files.get(file_path)
+            if entry is not None and tuple(entry[:2]) == stat and entry[2]:
+                return entry[2]
+            with open(abs_file_path, "rb") as f:
+                return hash_content(f.read())
+        except OSError:
+            return None
+
+    @property
+    def tokenizer_name(self) -> str:
+        return get_tokenizer_name(self.tokens_model)
+
     def get_files_paths(self):
-        absolute_paths = glob.glob(os.path.join(self.repo_path, "**"), recursive=True)
-        return [
-            os.path.relpath(path, self.repo_path)
-            for path in absolute_paths
-            if os.path.isfile(path)
-        ]
+        """Walk the repository, in parallel across its shards once they are known."""
+        if len(self._shards) > 1:
+            self._files_stats = walk_shards_files(
+                self.repo_path,
+                self._shards,
+                self.ignore_patterns,
+                self.include_hidden,
+                max_workers=self.tokens_workers,
+            )
+        else:
+            self._files_stats = walk_files(
+                self.repo_path,
+                self.ignore_patterns,
+                self.include_hidden,
+                progress_callback=lambda num_files: self._report_progress(
+                    "scanning", num_files, 0
+                ),
+            )
+        self._report_progress("scanning", len(self._files_stats), 0, force=True)
+        if self.detect_shards:
+            self._shards = detect_shards(self._files_stats)
+        return list(self._files_stats.keys())
+
+    def get_file_shard(self, file_path: str) -> str:
+        return get_file_shard(file_path, set(self._shards))
 
     def calculate_files_tokens(self):
-        for rel_file_path in self.files_paths:
-            abs_file_path = os.path.join(self.repo_path, rel_file_path)
-            try:
-                content = self._read_file(abs_file_path)
-                self.files_tokens[rel_file_path] = tokencost.count_string_tokens(
-                    content, "gpt-4o-mini"
+        self._tokens_cache = (
+            TokensCache.load_cache(self.repo_path, self._shards)
+            if self.use_tokens_cache
+            else TokensCache()
+        )
+        counted = self._count_files_tokens(
+            self.files_paths, estimate=self.is_estimate_mode
+        )
+        self._export_tokens_cache(counted)
+
+    def _count_files_tokens(
+        self, files_paths: List[str], estimate: bool = False
+    ) -> bool:
+        """Update the tokens of the given files, returning whether any was counted.
+
+        With estimate, files missing from the cache get tokens estimated from their
+        size and are counted in the background until apply_refined_tokens is called.
+        Otherwise the cache is checkpointed while counting, so that an interrupted
+        count resumes from the files already counted.
+        """
+        cache = self._tokens_cache
+        tokenizer_name = self.tokenizer_name
+        files_stats = {
+            file_path: self._files_stats.get(file_path)
+            or get_file_stat(os.path.join(self.repo_path, file_path))
+            for file_path in files_paths
+        }
+        too_large_files_paths = {
+            file_path
+            for file_path in files_paths
+            if files_stats[file_path][0] > self.max_file_size
+        }
+        stale_files_paths = [
+            file_path
+            for file_path in files_paths
+            if file_path not in too_large_files_paths
+            and not cache.is_fresh(file_path, files_stats[file_path], tokenizer_name)
+        ]
+        # without its tokenizer, e.g. offline, the tokens can only be estimated
+        tokenizer_loaded = get_tokenizer(tokenizer_name) is not None
+        if (estimate or not tokenizer_loaded) and stale_files_paths:
+            if tokenizer_loaded:
+                self._refine_files_tokens(
+                    stale_files_paths, files_stats, tokenizer_name
+                )
+            estimated_files_paths = set(stale_files_paths)
+            with self._cache_lock:
+                bytes_per_token = calibrate_bytes_per_token(
+                    cache.iter_counted_files(tokenizer_name)
                 )
-            except Exception:
-                self.files_tokens[rel_file_path] = None
+            stale_files_paths = []
+        else:
+            estimated_files_paths = set()
+        num_counted_files = 0
+        self._last_checkpoint = time.monotonic()
 
-    def _read_file(self, path):
-        with open(path, "r") as f:
-            return f.read()
+        def update_cache(results: dict):
+            nonlocal num_counted_files
+            self._update_tokens_cache(cache, results, files_stats, tokenizer_name)
+            num_counted_files += len(results)
+            self._report_progress("counting", num_counted_files, len(stale_files_paths))
 
-    def filter_files(
-        self, include_patterns: List[str] = [], exclude_patterns: List[str] = []
-    ) -> List[bool]:
-        self.included = []
-        self.included_files_paths = []
-        self.included_files_tokens = []
-        for file_path in self.files_paths:
-            tokens = self.files_tokens.get(file_path)
-            if tokens is None or tokens == 0:
-                self.included.append(False)
-                continue
+        count_files_tokens(
+            self.repo_path,
+            stale_files_paths,
+            tokenizer_name,
+            known_tokens=cache.get_tokenizer_tokens(tokenizer_name),
+            max_workers=self.tokens_workers,
+            chunk_size=self.tokens_chunk_size,
+            use_processes=self.tokens_use_processes,
+            on_chunk_counted=update_cache,
+        )
+        for file_path in files_paths:
+            if file_path in too_large_files_paths:
+                cache.files.pop(file_path, None)
+                self._table.set_file(file_path, None, "too large")
+            elif file_path in estimated_files_paths:
+                tokens = estimate_tokens(
+                    file_path, files_stats[file_path][0], bytes_per_token
+                )
+                self._table.set_file(file_path, tokens, estimated=True)
+            else:
+                self._table.set_file(
+                    file_path,
+                    cache.get_tokens(file_path, tokenizer_name),
+                    cache.get_skipped(file_path),
+                )
+        return bool(stale_files_paths)
+
+    def _update_tokens_cache(
+        self,
+        cache: TokensCache,
+        results: dict,
+        files_stats: dict,
+        tokenizer_name: str,
+    ):
+        """Record counted tokens in the cache, checkpointing it if still in use."""
+        with self._cache_lock:
+            for file_path, (content_hash, tokens, skipped) in results.items():
+                cache.update(
+                    file_path,
+                    files_stats[file_path],
+                    content_hash,
+                    tokens,
+                    skipped,
+                    tokenizer_name,
+                )
+            if cache is self._tokens_cache:
+                self._checkpoint_tokens_cache()
+
+    def _refine_files_tokens(
+        self, files_paths: List[str], files_stats: dict, tokenizer_name: str
+    ):
+        """Count the tokens of the files in the background.
+
+        The counts are checkpointed in the tokens cache as they are made, so an
+        interrupted count resumes from the files already counted, and replace
+        the estimated tokens once apply_refined_tokens is called.
+        """
+        cache = self._tokens_cache
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(
+            count_files_tokens,
+            self.repo_path,
+            files_paths,
+            tokenizer_name,
+            known_tokens=dict(self._tokens_cache.get_tokenizer_tokens(tokenizer_name)),
+            max_workers=self.tokens_workers,
+            chunk_size=self.tokens_chunk_size,
+            use_processes=self.tokens_use_processes,
+            on_chunk_counted=lambda results: self._update_tokens_cache(
+                cache, results, files_stats, tokenizer_name
+            ),
+        )
+        executor.shutdown(wait=False)
+        self._refining = (future, files_stats, tokenizer_name)
+
+    def wait_refined_tokens(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the background counts and apply them, see apply_refined_tokens."""
+        if self._refining is not None:
+            wait([self._refining[0]], timeout)
+        return self.apply_refined_tokens()
 
-            if include_patterns and not any(
-                self._match_path(file_path, pattern) for pattern in include_patterns
+    def apply_refined_tokens(self) -> bool:
+        """Replace the estimated tokens by their exact counts once they are ready.
+
+        Returns whether the tokens were updated. Counts of files modified since
+        they were estimated, or made with a tokenizer no longer used, are dropped.
+        """
+        if self._refining is None or not self._refining[0].done():
+            return False
+        future, files_stats, tokenizer_name = self._refining
+        self._refining = None
+        if tokenizer_name != self.tokenizer_name:
+            return False
+        refined_files_paths = []
+        for file_path, (_, tokens, skipped) in future.result().items():
+            # counts of the files modified since are never applied
+            if (
+                file_path not in self._table.estimated
+                or self._files_stats.get(file_path) != files_stats[file_path]
             ):
-                self.included.append(False)
                 continue
+            self._table.set_file(file_path, tokens, skipped)
+            refined_files_paths.append(file_path)
+        self._export_tokens_cache(bool(refined_files_paths))
+        self.filter_files(*self._filter_args)
+        return bool(refined_files_paths)
+
+    def _report_progress(self, stage: str, done: int, total: int, force: bool = False):
+        if self.progress_callback is None:
+            return
+        now = time.monotonic()
+        if force or done == total or now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            self.progress_callback(stage, done, total)
+
+    def _checkpoint_tokens_cache(self):
+        now = time.monotonic()
+        if (
+            self.use_tokens_cache
+            and now - self._last_checkpoint >= CACHE_CHECKPOINT_INTERVAL
+        ):
+            self._last_checkpoint = now
+            self._tokens_cache.export_cache(self.repo_path, self._shards)
 
-            if exclude_patterns and any(
-                self._match_path(file_path, pattern) for pattern in exclude_patterns
+    def _export_tokens_cache(self, changed: bool):
+        if not self.use_tokens_cache:
+            return
+        cache = self._tokens_cache
+        with self._cache_lock:
+            if changed or any(
+                file_path not in self._table for file_path in cache.files
             ):
-                self.included.append(False)
-                continue
+                cache.prune(self.files_paths)
+                cache.export_cache(self.repo_path, self._shards)
 
-            self.included.append(True)
-            self.included_files_paths.append(file_path)
-            self.included_files_tokens.append(tokens)
-
-    def _match_path(self, path: str, pattern: str) -> bool:
-        if pattern.endswith("/"):
-            pattern = pattern[:-1]  # remove trailing slash
-
-        if pattern.startswith("*") and pattern.endswith("*"):
-            return pattern[1:-1] in path
-        elif pattern.endswith("*"):
-            prefix = pattern.split("*")[0]
-            return path.startswith(prefix)
-        elif pattern.startswith("*"):
-            suffix = pattern.split("*")[1]
-            return path.endswith(suffix)
-        else:
-            return path == pattern or path.startswith(pattern + os.path.sep)
+    def set_tokens_model(self, model: str):
+        """Count the files tokens with the tokenizer of another model.
+
+        Nothing is recounted when both models share the same tokenizer, and only
+        the contents not yet counted with the new tokenizer are tokenized.
+        """
+        previous_tokenizer_name = self.tokenizer_name
+        self.tokens_model = model
+        if self.tokenizer_name == previous_tokenizer_name:
+            return
+        counted = self._count_files_tokens(
+            self.files_paths, estimate=self.is_estimate_mode
+        )
+        self._export_tokens_cache(counted)
+        self.filter_files(*self._filter_args)
+
+    def update_files(self, files_paths: List[str]):
+        """Apply the additions, modifications and deletions of files in place.
+
+        The path of a removed directory deletes all the files within it.
+        """
+        updated_files_paths = []
+        deleted_files_paths = []
+        for file_path in files_paths:
+            abs_file_path = os.path.join(self.repo_path, file_path)
+            if os.path.isfile(abs_file_path) and not is_path_ignored(
+                self.repo_path, file_path, self.ignore_patterns, self.include_hidden
+            ):
+                self._files_stats[file_path] = get_file_stat(abs_file_path)
+                updated_files_paths.append(file_path)
+            elif file_path in self._table:
+                self._files_stats.pop(file_path, None)
+                deleted_files_paths.append(file_path)
+            elif not os.path.exists(abs_file_path):
+                dir_prefix = f"{file_path}/"
+                for dir_file_path in self._table.paths:
+                    if dir_file_path.startswith(dir_prefix):
+                        self._files_stats.pop(dir_file_path, None)
+                        deleted_files_paths.append(dir_file_path)
+
+        self._table.remove_files(deleted_files_paths)
+        self._contents.invalidate(deleted_files_paths)
+        counted = self._count_files_tokens(updated_files_paths)
+        self._export_tokens_cache(counted)
+        self.filter_files(*self._filter_args)
+
+    def refresh(self):
+        """Rescan the repository, only re-reading the files that changed."""
+        self._table = FilesTable(self.get_files_paths())
+        self.calculate_files_tokens()
+        self.filter_files(*self._filter_args)
+
+    def filter_files(
+        self,
+        include_patterns: List[str] = [],
+        exclude_patterns: List[str] = [],
+        shards: Optional[List[str]] = None,
+    ):
+        """Include the files matching the patterns, within the given shards if any."""
+        self._filter_args = (include_patterns, exclude_patterns, shards)
+        include_matcher = compile_matcher(tuple(include_patterns))
+        exclude_matcher = compile_matcher(tuple(exclude_patterns))
+        all_shards = set(self._shards)
+        selected_shards = None if shards is None else set(shards)
+        mask = bytearray(len(self._table))
+        for i, (file_path, tokens) in enumerate(
+            zip(self._table.paths, self._table.tokens)
+        ):
+            if tokens <= 0:
+                continue
+            if (
+                selected_shards is not None
+                and get_file_shard(file_path, all_shards) not in selected_shards
+            ):
+                continue
+            if include_patterns and not include_matcher.match(file_path):
+                continue
+            if exclude_patterns and exclude_matcher.match(file_path):
+                continue
+            mask[i] = 1
+        self._table.set_mask(mask)
 
-    def read_file(self, file_path: str) -> str:
-        with open(os.path.join(self.repo_path, file_path), "r") as f:
-            return f.read()
+    def read_file(self, file_path: str, cache: bool = True) -> str:
+        return self._contents.read_text(file_path, cache=cache)
@@ -1,11 +1,67 @@
 import json
-from typing import Dict, List, Optional
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 
-import tokencost
 from pydantic import BaseModel
 
-from codeas.core.metadata import RepoMetadata
+from codeas.core.metadata import FileUsage, RepoMetadata
 from codeas.core.state import state
+from codeas.core.tokenizers import count_tokens
+from codeas.core.tokens_cache import FileStat
+
+
+class ContextFragments:
+    """Rendered context of the files, shared by the retrievers.
+
+    Fragments are kept by file path and mode with the stat of the file (size and
+    mtime) for its content, or the metadata they were rendered from otherwise,
+    and only reused while it matches.
+    They are kept in an LRU bounded by their total number of characters.
+    """
+
+    def __init__(self, max_chars: int = 64 * 1024 * 1024):
+        self.max_chars = max_chars
+        self._cache: OrderedDict[
+            Tuple[str, str], Tuple[Optional[FileStat], Any, str]
+        ] = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self, file_path: str, file_stat: Optional[FileStat], mode: str, source
+    ) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get((file_path, mode))
+            if entry is not None and entry[0] == file_stat and entry[1] is source:
+                self._cache.move_to_end((file_path, mode))
+                return entry[2]
+        return None
+
+    def put(
+        self,
+        file_path: str,
+        file_stat: Optional[FileStat],
+        mode: str,
+        source,
+        fragment: str,
+    ):
+        with self._lock:
+            self._pop((file_path, mode))
+            if len(fragment) > self.max_chars:
+                return
+            self._cache[(file_path, mode)] = (file_stat, source, fragment)
+            self._chars += len(fragment)
+            while self._chars > self.max_chars:
+                self._pop(next(iter(self._cache)))
+
+    def _pop(self, key: Tuple[str, str]):
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            self._chars -= len(entry[2])
+
+
+context_fragments = ContextFragments()
 
 
 class ContextRetriever(BaseModel):
@@ -19,6 +75,7 @@ class ContextRetriever(BaseModel):
     include_api_files: bool = False
     use_descriptions: bool = False
     use_details: bool = False
+    tokens_model: str = "gpt-4o"
 
     def retrieve(
         self,
@@ -49,35 +106,65 @@ class ContextRetriever(BaseModel):
                     file_header += f" [{files_tokens[i]} tokens]"
 
                 if self.use_details and file_usage.is_code:
-                    if file_usage.testing_related:
-                        details = metadata.get_testing_details(file_path)
-                    else:
-                        details = metadata.get_code_details(file_path)
-                    if details:
-                        context.append(
-                            f"{file_header}:\n{self.parse_json_response(details.model_dump_json())}"
-                        )
+                    mode = "details"
                 elif self.use_descriptions:
-                    if file_usage.is_code:
-                        details = (
-                            metadata.get_code_details(file_path)
-                            if not file_usage.testing_related
-                            else metadata.get_testing_details(file_path)
-                        )
-                        if details:
-                            description = f"{file_header}:\n{details.description}"
-                            if details.external_imports:
-                                description += f"\nExternal imports: {', '.join(details.external_imports)}"
-                            context.append(description)
-                    else:
-                        description = metadata.get_file_description(file_path)
-                        context.append(f"{file_header}:\n{description}")
+                    mode = "descriptions"
                 else:
-                    content = state.repo.read_file(file_path)
-                    context.append(f"{file_header}:\n{content}")
+                    mode = "content"
+                fragment = self.get_fragment(file_path, mode, file_usage, metadata)
+                if fragment is not None:
+                    context.append(f"{file_header}:\n{fragment}")
 
         return "\n\n".join(context)
 
+    def get_fragment(
+        self,
+        file_path: str,
+        mode: str,
+        file_usage: Optional[FileUsage],
+        metadata: Optional[RepoMetadata],
+    ) -> Optional[str]:
+        """Return the context of a file in the given mode, None if it has none.
+
+        Modes are "content", "descriptions" and "details". Fragments are cached
+        with the stat of the file or the metadata they were rendered from, so a
+        file is only rendered again once it or its metadata changes.
+        """
+        if mode == "content":
+            source = None
+        elif mode == "descriptions" and not file_usage.is_code:
+            source = metadata.get_file_description(file_path)
+        else:
+            source = (
+                metadata.get_code_details(file_path)
+                if not file_usage.testing_related
+                else metadata.get_testing_details(file_path)
+            )
+            if not source:
+                return None
+        # the content is validated by its stat as in FileContents, without
+        # reading or hashing the file
+        file_stat = state.repo.get_file_stat(file_path) if mode == "content" else None
+        fragment = context_fragments.get(file_path, file_stat, mode, source)
+        if fragment is None:
+            fragment = self.render_fragment(file_path, mode, source)
+            context_fragments.put(file_path, file_stat, mode, source, fragment)
+        return fragment
+
+    def render_fragment(self, file_path: str, mode: str, source) -> str:
+        if mode == "content":
+            return state.repo.read_file(file_path)
+        if mode == "details":
+            return self.parse_json_response(source.model_dump_json())
+        if isinstance(source, BaseModel):
+            description = source.description
+            if source.external_imports:
+                description += (
+                    f"\nExternal imports: {', '.join(source.external_imports)}"
+                )
+            return description
+        return str(source)
+
     def parse_json_response(self, json_str: str) -> str:
         data = json.loads(json_str)
         result = []
@@ -125,37 +212,18 @@ class ContextRetriever(BaseModel):
 
         # Count tokens for the file header
         file_header = f"# {file_path}"
-        total_tokens = tokencost.count_string_tokens(file_header, "gpt-4o")
+        total_tokens = count_tokens(file_header, self.tokens_model)
 
         if self.use_descriptions:
-            if file_usage.is_code:
-                details = (
-                    metadata.get_code_details(file_path)
-                    if not file_usage.testing_related
-                    else metadata.get_testing_details(file_path)
-                )
-                if details:
-                    description = details.description
-                    if details.external_imports:
-                        description += (
-                            f"\nExternal imports: {', '.join(details.external_imports)}"
-                        )
-                    total_tokens += tokencost.count_string_tokens(description, "gpt-4o")
-            else:
-                description = metadata.get_file_description(file_path)
-                total_tokens += tokencost.count_string_tokens(description, "gpt-4o")
+            mode = "descriptions"
         elif self.use_details and file_usage.is_code:
-            details = (
-                metadata.get_code_details(file_path)
-                if not file_usage.testing_related
-                else metadata.get_testing_details(file_path)
-            )
-            if details:
-                details_str = self.parse_json_response(details.model_dump_json())
-                total_tokens += tokencost.count_string_tokens(details_str, "gpt-4o")
+            mode = "details"
         else:
             # otherwise, return the full files number of tokens
-            total_tokens = state.repo.files_tokens[file_path]
+            return state.repo.get_file_tokens(file_path)
+        fragment = self.get_fragment(file_path, mode, file_usage, metadata)
+        if fragment is not None:
+            total_tokens += count_tokens(fragment, self.tokens_model)
 
         return total_tokens
 
@@ -186,5 +254,7 @@ class ContextRetriever(BaseModel):
 if __name__ == "__main__":
     metadata = RepoMetadata.load_metadata(".")
     retriever = ContextRetriever(include_all_files=True, use_descriptions=True)
-    context = retriever.retrieve(metadata.descriptions.keys(), metadata)
+    context = retriever.retrieve(
+        metadata.get_metadata_files_paths("descriptions"), metadata
+    )
     print(context)
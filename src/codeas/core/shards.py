@@ -0,0 +1,46 @@
+import os
+from typing import Dict, Iterable, List, Set
+
+# files marking the root directory of a sub-project
+SHARD_MARKERS = ("pyproject.toml", "package.json", "go.mod")
+ROOT_SHARD = ""
+
+
+def detect_shards(files_paths: Iterable[str]) -> List[str]:
+    """Return the directories of the sub-projects found among the files.
+
+    The repository root is always a shard, holding the files of no sub-project.
+    """
+    shards = {
+        os.path.dirname(file_path)
+        for file_path in files_paths
+        if os.path.basename(file_path) in SHARD_MARKERS
+    }
+    shards.add(ROOT_SHARD)
+    return sorted(shards)
+
+
+def get_file_shard(file_path: str, shards: Set[str]) -> str:
+    """Return the innermost shard containing the file."""
+    dir_path = os.path.dirname(file_path)
+    while dir_path and dir_path not in shards:
+        dir_path = os.path.dirname(dir_path)
+    return dir_path
+
+
+def group_by_shard(
+    files_paths: Iterable[str], shards: Iterable[str]
+) -> Dict[str, list]:
+    shards = set(shards) | {ROOT_SHARD}
+    groups = {shard: [] for shard in sorted(shards)}
+    for file_path in files_paths:
+        groups[get_file_shard(file_path, shards)].append(file_path)
+    return groups
+
+
+def to_shard_path(file_path: str, shard: str) -> str:
+    return file_path[len(shard) + 1 :] if shard else file_path
+
+
+def from_shard_path(shard_file_path: str, shard: str) -> str:
+    return os.path.join(shard, shard_file_path) if shard else shard_file_path
@@ -1,56 +1,136 @@
 import json
 import os
-from typing import Dict, List
+from typing import Callable, Dict, List, Literal, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 from codeas.core.llm import LLMClient
 from codeas.core.metadata import RepoMetadata
 from codeas.core.repo import Repo
+from codeas.core.watcher import RepoWatcher
 
 
 class PageFilter(BaseModel):
     include: str = ""
     exclude: str = ""
+    shards: List[str] = []
 
 
 class State(BaseModel, arbitrary_types_allowed=True, extra="forbid"):
+    """Shared state of the UI pages.
+
+    The repository is only scanned and its metadata loaded when first accessed,
+    so that importing this module and pages not using them stay cheap.
+    """
+
     current_page: str = ""
     repo_path: str = "."
     llm_client: LLMClient = None
-    repo: Repo = None
-    repo_metadata: RepoMetadata = None
+    repo_watcher: RepoWatcher = None
     page_filters: Dict[str, PageFilter] = Field(default_factory=dict)
-    files_data: Dict[str, List] = Field(
-        default_factory=lambda: {"Incl.": [], "Path": [], "Tokens": []}
-    )
+    # see Repo.tokens_mode and Repo.detect_shards
+    tokens_mode: Literal["exact", "estimate", "auto"] = "auto"
+    detect_shards: bool = True
+    _repo: Optional[Repo] = PrivateAttr(default=None)
+    _repo_metadata: Optional[RepoMetadata] = PrivateAttr(default=None)
 
     def __init__(self, **data):
         super().__init__(**data)
         self.llm_client = LLMClient()
         self.load_page_filters()
-        self.repo = Repo(repo_path=self.repo_path)
-        self.repo_metadata = RepoMetadata.load_metadata(self.repo_path)
-        self.update_files_data()
+
+    @property
+    def repo(self) -> Repo:
+        return self.load_repo()
+
+    @property
+    def repo_metadata(self) -> RepoMetadata:
+        if self._repo_metadata is None:
+            self._repo_metadata = RepoMetadata.load_metadata(
+                self.repo_path, self.repo.shards
+            )
+        return self._repo_metadata
+
+    @property
+    def files_data(self) -> Dict[str, List]:
+        return self.repo.files_table.sorted_columns
+
+    @property
+    def is_repo_loaded(self) -> bool:
+        return self._repo is not None
+
+    def load_repo(
+        self, progress_callback: Optional[Callable[[str, int, int], None]] = None
+    ) -> Repo:
+        """Scan the repository if not done yet, see Repo.progress_callback.
+
+        Token counts are checkpointed in the tokens cache while scanning, so an
+        interrupted scan resumes from the files already counted.
+        """
+        if self._repo is None:
+            repo = Repo(
+                repo_path=self.repo_path,
+                tokens_mode=self.tokens_mode,
+                detect_shards=self.detect_shards,
+                progress_callback=progress_callback,
+            )
+            repo.progress_callback = None
+            self._repo = repo
+            self.apply_filters()
+        return self._repo
 
     def update_repo_path(self, repo_path: str):
         self.repo_path = repo_path
-        self.repo = Repo(repo_path=repo_path)
-        self.repo_metadata = RepoMetadata.load_metadata(repo_path)
+        self._repo = None
+        self._repo_metadata = None
         self.load_page_filters()
-        self.update_files_data()
+        if self.repo_watcher is not None:
+            self.start_repo_watcher()
+
+    def update_repo_settings(
+        self,
+        tokens_mode: Literal["exact", "estimate", "auto"],
+        detect_shards: bool,
+    ):
+        """Change how the repository is scanned, scanning it again if needed."""
+        if (tokens_mode, detect_shards) != (self.tokens_mode, self.detect_shards):
+            self.tokens_mode = tokens_mode
+            self.detect_shards = detect_shards
+            self._repo = None
+            self._repo_metadata = None
 
     def update_current_page(self, page_name: str):
         self.current_page = page_name
         self.load_page_filters()
-        self.apply_filters()
-
-    def update_files_data(self):
-        self.files_data = {
-            "Incl.": self.repo.included,
-            "Path": self.repo.files_paths,
-            "Tokens": list(self.repo.files_tokens.values()),
-        }
+        if self.is_repo_loaded:
+            self.sync_repo()
+            self.apply_filters()
+
+    def start_repo_watcher(self):
+        self.stop_repo_watcher()
+        self.repo_watcher = RepoWatcher(
+            self.repo.repo_path, self.repo.ignore_patterns, self.repo.include_hidden
+        )
+        self.repo_watcher.start()
+
+    def stop_repo_watcher(self):
+        if self.repo_watcher is not None:
+            self.repo_watcher.stop()
+            self.repo_watcher = None
+
+    def sync_repo(self):
+        """Apply the background token counts and watcher changes since last sync."""
+        self.repo.apply_refined_tokens()
+        if self.repo_watcher is None:
+            return
+        changed_files_paths, rescan = self.repo_watcher.pop_changes()
+        if rescan:
+            self.repo.refresh()
+        elif changed_files_paths:
+            self.repo.update_files(list(changed_files_paths))
+
+    def update_tokens_model(self, model: str):
+        self.repo.set_tokens_model(model)
 
     def write_output(self, output: dict, path: str):
         if not os.path.exists(f"{self.repo_path}/.codeas/outputs"):
@@ -86,8 +166,9 @@ class State(BaseModel, arbitrary_types_allowed=True, extra="forbid"):
             for pattern in page_filter.exclude.split(",")
             if pattern.strip()
         ]
-        self.repo.filter_files(include_patterns, exclude_patterns)
-        self.update_files_data()
+        self.repo.filter_files(
+            include_patterns, exclude_patterns, page_filter.shards or None
+        )
 
     def save_page_filters(self):
         page_filters_dict = {
@@ -0,0 +1,183 @@
+import ast
+import os
+import sys
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from pydantic import BaseModel
+
+from codeas.core.tokens import get_extension
+
+
+class StaticDetails(BaseModel):
+    external_imports: List[str]
+    internal_imports: List[str]
+    classes: List[str]
+
+
+# files are never taken for modules of the standard library, e.g. utils/json.py
+# imported as json from utils
+STDLIB_MODULES = frozenset(
+    getattr(sys, "stdlib_module_names", sys.builtin_module_names)
+)
+# analyzers take the content of a file and the modules of the repository
+Analyzer = Callable[[str, Set[str]], StaticDetails]
+ANALYZERS: Dict[str, Analyzer] = {}
+
+
+def register_analyzer(extensions: Iterable[str], analyzer: Analyzer):
+    for extension in extensions:
+        ANALYZERS[extension] = analyzer
+
+
+def analyze_file(
+    file_path: str, content: str, internal_modules: Set[str]
+) -> Optional[StaticDetails]:
+    """Extract the imports and classes of a file, None if it can't be analyzed."""
+    analyzer = ANALYZERS.get(get_extension(file_path))
+    if analyzer is None:
+        return None
+    try:
+        return analyzer(content, internal_modules)
+    except (SyntaxError, ValueError, RecursionError):
+        return None
+
+
+def get_internal_modules(files_paths: Iterable[str]) -> Set[str]:
+    """Return the dotted names the files and their packages can be imported as."""
+    modules = set()
+    for module in get_modules_files(files_paths):
+        parts = module.split(".")
+        modules.update(".".join(parts[:end]) for end in range(1, len(parts) + 1))
+    return modules
+
+
+def get_modules_files(files_paths: Iterable[str]) -> Dict[str, str]:
+    """Map the dotted names the files can be imported as to their path.
+
+    Only files of languages with an analyzer are modules, imported from the
+    roots returned by get_import_roots, except the names of the standard library.
+    """
+    files_paths = [
+        file_path for file_path in files_paths if get_extension(file_path) in ANALYZERS
+    ]
+    packages = {
+        os.path.dirname(file_path)
+        for file_path in files_paths
+        if os.path.splitext(os.path.basename(file_path))[0] == "__init__"
+    }
+    modules_files = {}
+    for file_path in files_paths:
+        parts = get_module_parts(file_path)
+        for root in sorted(get_import_roots(file_path, packages)):
+            module = ".".join(parts[root:])
+            if module and parts[root] not in STDLIB_MODULES:
+                modules_files.setdefault(module, file_path)
+    return modules_files
+
+
+def get_import_roots(file_path: str, packages: Set[str]) -> Set[int]:
+    """Return the numbers of leading directories a file can be imported without.
+
+    Files are imported from the repository root, from a src directory at its
+    root, or from the directory holding their top-level package.
+    """
+    dirs = file_path.split("/")[:-1]
+    roots = {0}
+    if dirs[:1] == ["src"]:
+        roots.add(1)
+    root = len(dirs)
+    while root and "/".join(dirs[:root]) in packages:
+        root -= 1
+    roots.add(root)
+    return roots
+
+
+def get_module_parts(file_path: str) -> List[str]:
+    parts = os.path.splitext(file_path)[0].split("/")
+    if parts[-1] == "__init__" and len(parts) > 1:
+        parts.pop()
+    return parts
+
+
+def count_inbound_imports(
+    files_paths: List[str], read_file: Callable[[str], str]
+) -> Dict[str, int]:
+    """Count the files importing each file, among those that can be analyzed."""
+    internal_modules = get_internal_modules(files_paths)
+    modules_files = get_modules_files(files_paths)
+    inbound_imports = {}
+    for file_path in files_paths:
+        if get_extension(file_path) not in ANALYZERS:
+            continue
+        try:
+            content = read_file(file_path)
+        except (OSError, UnicodeDecodeError):
+            continue
+        static_details = analyze_file(file_path, content, internal_modules)
+        if static_details is None:
+            continue
+        imported_files_paths = {
+            resolve_import(file_path, module, modules_files)
+            for module in static_details.internal_imports
+        }
+        for imported_file_path in imported_files_paths - {None, file_path}:
+            inbound_imports[imported_file_path] = (
+                inbound_imports.get(imported_file_path, 0) + 1
+            )
+    return inbound_imports
+
+
+def resolve_import(
+    file_path: str, module: str, modules_files: Dict[str, str]
+) -> Optional[str]:
+    """Return the file imported as module by the given file, if found."""
+    level = len(module) - len(module.lstrip("."))
+    if level:
+        package = file_path.split("/")[:-level]
+        module = ".".join([*package, module[level:]] if module[level:] else package)
+    while module:
+        if module in modules_files:
+            return modules_files[module]
+        # the imported name may be an attribute of the module
+        module = module.rpartition(".")[0]
+    return None
+
+
+def analyze_python(content: str, internal_modules: Set[str]) -> StaticDetails:
+    tree = ast.parse(content)
+    external_imports, internal_imports, classes = {}, {}, {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ClassDef):
+            classes[node.name] = None
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                if is_internal_module(alias.name, internal_modules):
+                    internal_imports[alias.name] = None
+                else:
+                    external_imports[alias.name.split(".")[0]] = None
+        elif isinstance(node, ast.ImportFrom):
+            if not node.level and not is_internal_module(node.module, internal_modules):
+                external_imports[node.module.split(".")[0]] = None
+                continue
+            # imported names may be modules themselves
+            prefix = "." * node.level + (f"{node.module}." if node.module else "")
+            for alias in node.names:
+                if not node.module or f"{node.module}.{alias.name}" in internal_modules:
+                    internal_imports[prefix + alias.name] = None
+                else:
+                    internal_imports[prefix[:-1]] = None
+    return StaticDetails(
+        external_imports=list(external_imports),
+        internal_imports=list(internal_imports),
+        classes=list(classes),
+    )
+
+
+def is_internal_module(module: str, internal_modules: Set[str]) -> bool:
+    parts = module.split(".")
+    return any(
+        ".".join(parts[:end]) in internal_modules for end in range(1, len(parts) + 1)
+    )
+
+
+register_analyzer([".py", ".pyi"], analyze_python)
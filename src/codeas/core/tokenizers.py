@@ -0,0 +1,73 @@
+import logging
+from functools import lru_cache
+from typing import List, Optional
+
+import tiktoken
+
+from codeas.core.clients import MODELS
+
+# Anthropic and Google don't provide local tokenizers,
+# so cl100k_base is used to approximate the tokens of their models
+PROVIDERS_TOKENIZERS = {
+    "openai": "o200k_base",
+    "anthropic": "cl100k_base",
+    "google": "cl100k_base",
+}
+DEFAULT_TOKENIZER = "o200k_base"
+# tokens are approximated from the size of the texts when the tokenizer can't be
+# loaded, e.g. offline before tiktoken downloaded its files
+FALLBACK_BYTES_PER_TOKEN = 4.0
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer_name(model: str) -> str:
+    """Resolve the tokenizer of a model from its provider in clients.MODELS."""
+    provider = MODELS.get(model) or next(
+        (provider for name, provider in MODELS.items() if model.startswith(name)),
+        None,
+    )
+    if provider is not None:
+        return PROVIDERS_TOKENIZERS[provider]
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        return DEFAULT_TOKENIZER
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(tokenizer_name: str) -> Optional[tiktoken.Encoding]:
+    """Load a tokenizer, None if it can't be loaded."""
+    try:
+        return tiktoken.get_encoding(tokenizer_name)
+    except Exception as e:
+        logging.warning("Could not load the %s tokenizer: %s", tokenizer_name, e)
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    tokenizer = get_tokenizer(get_tokenizer_name(model))
+    if tokenizer is None:
+        return approximate_tokens(text)
+    return len(tokenizer.encode_ordinary(text))
+
+
+def count_tokens_batch(
+    texts: List[str], tokenizer_name: str, num_threads: int = 1
+) -> List[int]:
+    if not texts:
+        return []
+    tokenizer = get_tokenizer(tokenizer_name)
+    if tokenizer is None:
+        return [approximate_tokens(text) for text in texts]
+    if num_threads == 1:
+        return [len(tokenizer.encode_ordinary(text)) for text in texts]
+    return [
+        len(tokens)
+        for tokens in tokenizer.encode_ordinary_batch(texts, num_threads=num_threads)
+    ]
+
+
+def approximate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    return max(1, round(len(text.encode()) / FALLBACK_BYTES_PER_TOKEN))
@@ -0,0 +1,199 @@
+import codecs
+import hashlib
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from codeas.core.tokenizers import count_tokens_batch
+
+TOKENS_MODEL = "gpt-4o-mini"
+SNIFF_SIZE = 8192
+NON_UTF8_BOMS = (
+    codecs.BOM_UTF16_LE,
+    codecs.BOM_UTF16_BE,
+    codecs.BOM_UTF32_LE,
+    codecs.BOM_UTF32_BE,
+)
+
+# average bytes per token of common extensions, used to estimate the tokens of
+# a file from its size until enough files of its extension have been counted
+BYTES_PER_TOKEN = {
+    ".py": 3.8,
+    ".js": 3.6,
+    ".ts": 3.6,
+    ".tsx": 3.4,
+    ".java": 4.2,
+    ".go": 3.6,
+    ".rs": 3.6,
+    ".c": 3.4,
+    ".cpp": 3.4,
+    ".h": 3.6,
+    ".html": 3.2,
+    ".css": 3.2,
+    ".json": 2.8,
+    ".yaml": 3.2,
+    ".yml": 3.2,
+    ".toml": 3.2,
+    ".md": 4.2,
+    ".txt": 4.4,
+}
+DEFAULT_BYTES_PER_TOKEN = 4.0
+MIN_CALIBRATION_FILES = 5
+
+# content hash, tokens and the reason why the file was skipped, if it was
+FileTokens = Tuple[Optional[str], Optional[int], Optional[str]]
+
+
+def hash_content(content: bytes) -> str:
+    return hashlib.sha1(content).hexdigest()
+
+
+def sniff_content(head: bytes) -> Optional[str]:
+    """Return the reason to skip a file from its first block, if any."""
+    if head.startswith(NON_UTF8_BOMS):
+        return "not utf-8"
+    if b"\x00" in head:
+        return "binary"
+    return None
+
+
+def read_file_for_tokens(
+    abs_file_path: str, known_tokens: Optional[Dict[str, int]] = None
+) -> Tuple[Optional[str], Union[str, int, None], Optional[str]]:
+    """Return the content hash of a file with either its known tokens or its text.
+
+    Binary files are detected from their first block and skipped without being
+    fully read, in which case the reason is returned instead.
+    """
+    try:
+        with open(abs_file_path, "rb") as f:
+            head = f.read(SNIFF_SIZE)
+            skipped = sniff_content(head)
+            if skipped:
+                return None, None, skipped
+            content = head + f.read()
+    except OSError:
+        return None, None, "unreadable"
+    content_hash = hash_content(content)
+    if known_tokens and content_hash in known_tokens:
+        return content_hash, known_tokens[content_hash], None
+    try:
+        return content_hash, content.decode(), None
+    except UnicodeDecodeError:
+        return content_hash, None, "not utf-8"
+
+
+def calibrate_bytes_per_token(
+    counted_files: Iterable[Tuple[str, int, int]],
+) -> Dict[str, float]:
+    """Compute the bytes per token of each extension from (path, size, tokens).
+
+    Extensions with fewer than MIN_CALIBRATION_FILES counted files keep their
+    default ratio.
+    """
+    totals = {}
+    for file_path, size, tokens in counted_files:
+        if size > 0 and tokens > 0:
+            total = totals.setdefault(get_extension(file_path), [0, 0, 0])
+            total[0] += size
+            total[1] += tokens
+            total[2] += 1
+    bytes_per_token = dict(BYTES_PER_TOKEN)
+    for extension, (size, tokens, num_files) in totals.items():
+        if num_files >= MIN_CALIBRATION_FILES:
+            bytes_per_token[extension] = size / tokens
+    return bytes_per_token
+
+
+def estimate_tokens(
+    file_path: str, size: int, bytes_per_token: Dict[str, float] = BYTES_PER_TOKEN
+) -> int:
+    if size == 0:
+        return 0
+    ratio = bytes_per_token.get(get_extension(file_path), DEFAULT_BYTES_PER_TOKEN)
+    return max(1, round(size / ratio))
+
+
+def get_extension(file_path: str) -> str:
+    return os.path.splitext(file_path)[1].lower()
+
+
+def count_files_tokens(
+    repo_path: str,
+    files_paths: List[str],
+    tokenizer_name: str,
+    known_tokens: Optional[Dict[str, int]] = None,
+    max_workers: Optional[int] = None,
+    chunk_size: int = 256,
+    use_processes: bool = False,
+    on_chunk_counted: Optional[Callable[[Dict[str, FileTokens]], None]] = None,
+) -> Dict[str, FileTokens]:
+    """Count the tokens of the given files in chunks spread over a worker pool.
+
+    Files whose content hash is already in known_tokens are not tokenized again.
+    Threads are used by default since both file reads and tiktoken encoding
+    release the GIL; processes can be used instead when the tokenizer doesn't.
+    on_chunk_counted is called from the calling thread with the results of each
+    chunk as soon as it is counted, in order.
+    """
+    chunks = [
+        files_paths[i : i + chunk_size] for i in range(0, len(files_paths), chunk_size)
+    ]
+    if max_workers == 1 or len(chunks) <= 1:
+        results = (
+            _count_chunk_tokens(repo_path, chunk, tokenizer_name, known_tokens)
+            for chunk in chunks
+        )
+        return _collect_chunks_tokens(chunks, results, on_chunk_counted)
+    with _get_executor(max_workers, use_processes) as executor:
+        results = executor.map(
+            _count_chunk_tokens,
+            repeat(repo_path),
+            chunks,
+            repeat(tokenizer_name),
+            repeat(known_tokens),
+        )
+        return _collect_chunks_tokens(chunks, results, on_chunk_counted)
+
+
+def _collect_chunks_tokens(
+    chunks: List[List[str]],
+    results: Iterable[List[FileTokens]],
+    on_chunk_counted: Optional[Callable[[Dict[str, FileTokens]], None]],
+) -> Dict[str, FileTokens]:
+    files_tokens = {}
+    for chunk, chunk_results in zip(chunks, results):
+        chunk_tokens = dict(zip(chunk, chunk_results))
+        if on_chunk_counted is not None:
+            on_chunk_counted(chunk_tokens)
+        files_tokens.update(chunk_tokens)
+    return files_tokens
+
+
+def _count_chunk_tokens(
+    repo_path: str,
+    files_paths: List[str],
+    tokenizer_name: str,
+    known_tokens: Optional[Dict[str, int]],
+) -> List[FileTokens]:
+    results = [
+        read_file_for_tokens(os.path.join(repo_path, file_path), known_tokens)
+        for file_path in files_paths
+    ]
+    texts_indices = [
+        i for i, (_, content, _) in enumerate(results) if isinstance(content, str)
+    ]
+    texts_tokens = count_tokens_batch(
+        [results[i][1] for i in texts_indices], tokenizer_name
+    )
+    for i, tokens in zip(texts_indices, texts_tokens):
+        results[i] = (results[i][0], tokens, None)
+    return results
+
+
+def _get_executor(max_workers: Optional[int], use_processes: bool) -> Executor:
+    max_workers = max_workers or os.cpu_count() or 1
+    if use_processes:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers)
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+
+from codeas.core.shards import (
+    ROOT_SHARD,
+    from_shard_path,
+    group_by_shard,
+    to_shard_path,
+)
+
+FileStat = Tuple[int, int]
+
+
+class TokensCache(BaseModel):
+    """Per-file token counts persisted in the .codeas/tokens_cache.json of each shard.
+
+    Files are keyed by path with their size, mtime, content hash and the reason
+    they were skipped (binary, not utf-8, ...), while token counts are keyed by
+    content hash so unchanged content is never tokenized twice, even when it is
+    moved or touched. Token counts are kept per tokenizer so that switching
+    between models sharing a tokenizer needs no recount.
+    """
+
+    files: Dict[str, Tuple[int, int, Optional[str], Optional[str]]] = Field(default={})
+    tokens: Dict[str, Dict[str, int]] = Field(default={})
+
+    def get_tokenizer_tokens(self, tokenizer_name: str) -> Dict[str, int]:
+        return self.tokens.setdefault(tokenizer_name, {})
+
+    def is_fresh(self, file_path: str, stat: FileStat, tokenizer_name: str) -> bool:
+        entry = self.files.get(file_path)
+        return (
+            entry is not None
+            and tuple(entry[:2]) == stat
+            and (
+                entry[3] is not None
+                or entry[2] in self.get_tokenizer_tokens(tokenizer_name)
+            )
+        )
+
+    def get_tokens(self, file_path: str, tokenizer_name: str) -> Optional[int]:
+        return self.get_tokenizer_tokens(tokenizer_name).get(self.files[file_path][2])
+
+    def iter_counted_files(self, tokenizer_name: str) -> Iterator[Tuple[str, int, int]]:
+        """Yield the path, size and tokens of the files counted with a tokenizer."""
+        tokenizer_tokens = self.get_tokenizer_tokens(tokenizer_name)
+        for file_path, (size, _, content_hash, _) in self.files.items():
+            if content_hash in tokenizer_tokens:
+                yield file_path, size, tokenizer_tokens[content_hash]
+
+    def get_skipped(self, file_path: str) -> Optional[str]:
+        return self.files[file_path][3]
+
+    def update(
+        self,
+        file_path: str,
+        stat: FileStat,
+        content_hash: Optional[str],
+        tokens: Optional[int],
+        skipped: Optional[str],
+        tokenizer_name: str,
+    ):
+        self.files[file_path] = (*stat, content_hash, skipped)
+        if content_hash is not None and tokens is not None:
+            self.get_tokenizer_tokens(tokenizer_name)[content_hash] = tokens
+
+    def prune(self, files_paths: List[str]):
+        """Drop deleted files and the token counts no file refers to anymore."""
+        files_paths = set(files_paths)
+        self.files = {
+            path: entry for path, entry in self.files.items() if path in files_paths
+        }
+        hashes = {entry[2] for entry in self.files.values()}
+        self.tokens = {
+            tokenizer_name: {h: t for h, t in tokens.items() if h in hashes}
+            for tokenizer_name, tokens in self.tokens.items()
+        }
+
+    def split(self, shards: List[str]) -> Dict[str, "TokensCache"]:
+        """Split the cache by shard, with paths relative to their shard."""
+        caches = {}
+        for shard, files_paths in group_by_shard(self.files, shards).items():
+            cache = TokensCache(
+                files={
+                    to_shard_path(file_path, shard): self.files[file_path]
+                    for file_path in files_paths
+                },
+                tokens=self.tokens,
+            )
+            cache.prune(cache.files)
+            caches[shard] = cache
+        return caches
+
+    @classmethod
+    def merge(cls, shards_caches: Dict[str, "TokensCache"]) -> "TokensCache":
+        """Merge the caches of shards, inner shards taking precedence."""
+        cache = cls()
+        for shard in sorted(shards_caches):
+            shard_cache = shards_caches[shard]
+            cache.files.update(
+                (from_shard_path(file_path, shard), entry)
+                for file_path, entry in shard_cache.files.items()
+            )
+            for tokenizer_name, tokens in shard_cache.tokens.items():
+                cache.get_tokenizer_tokens(tokenizer_name).update(tokens)
+        return cache
+
+    def export_cache(self, repo_path: str, shards: List[str] = [ROOT_SHARD]):
+        """Export the cache, split in one file per shard."""
+        if shards == [ROOT_SHARD]:
+            self._export_cache_file(get_cache_path(repo_path))
+            return
+        for shard, cache in self.split(shards).items():
+            cache._export_cache_file(get_cache_path(os.path.join(repo_path, shard)))
+
+    def _export_cache_file(self, cache_path: str):
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path, "w") as f:
+                json.dump(self.model_dump(), f)
+        except OSError as e:
+            logging.warning("Could not write tokens cache %s: %s", cache_path, e)
+
+    @classmethod
+    def load_cache(
+        cls, repo_path: str, shards: List[str] = [ROOT_SHARD]
+    ) -> "TokensCache":
+        """Load the cache of each shard, skipping those missing or unreadable."""
+        if shards == [ROOT_SHARD]:
+            return cls._load_cache_file(get_cache_path(repo_path))
+        return cls.merge(
+            {
+                shard: cls._load_cache_file(
+                    get_cache_path(os.path.join(repo_path, shard))
+                )
+                for shard in shards
+            }
+        )
+
+    @classmethod
+    def _load_cache_file(cls, cache_path: str) -> "TokensCache":
+        try:
+            with open(cache_path, "r") as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError):
+            return cls()
+
+
+def get_cache_path(repo_path: str) -> str:
+    return os.path.join(repo_path, ".codeas", "tokens_cache.json")
+
+
+def get_file_stat(abs_file_path: str) -> FileStat:
+    stat = os.stat(abs_file_path)
+    return stat.st_size, stat.st_mtime_ns
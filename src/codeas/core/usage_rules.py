@@ -0,0 +1,187 @@
+import os
+import re
+from typing import Dict, Tuple
+
+from codeas.core.tokens import get_extension
+
+CODE_EXTENSIONS = {
+    ".py",
+    ".pyi",
+    ".js",
+    ".jsx",
+    ".mjs",
+    ".cjs",
+    ".ts",
+    ".tsx",
+    ".java",
+    ".kt",
+    ".scala",
+    ".go",
+    ".rs",
+    ".rb",
+    ".php",
+    ".c",
+    ".h",
+    ".cc",
+    ".cpp",
+    ".hpp",
+    ".cs",
+    ".swift",
+    ".m",
+    ".vue",
+    ".svelte",
+    ".dart",
+    ".ex",
+    ".exs",
+    ".lua",
+}
+CONFIG_EXTENSIONS = {
+    ".yaml",
+    ".yml",
+    ".toml",
+    ".ini",
+    ".cfg",
+    ".conf",
+    ".env",
+    ".properties",
+}
+CONFIG_NAMES = {
+    "package.json",
+    "tsconfig.json",
+    "setup.cfg",
+    "tox.ini",
+    "requirements.txt",
+    ".editorconfig",
+    ".gitignore",
+    ".dockerignore",
+    ".pre-commit-config.yaml",
+    ".eslintrc",
+    ".eslintrc.json",
+    ".prettierrc",
+    "babel.config.json",
+    "go.mod",
+    "go.sum",
+    "pom.xml",
+    "build.gradle",
+    "gemfile",
+    "pipfile",
+}
+DATA_EXTENSIONS = {
+    ".md",
+    ".rst",
+    ".txt",
+    ".json",
+    ".csv",
+    ".tsv",
+    ".xml",
+    ".lock",
+    ".svg",
+    ".sql",
+    ".html",
+    ".css",
+    ".scss",
+    ".sass",
+    ".less",
+    ".ipynb",
+}
+DEPLOYMENT_NAMES = {
+    "dockerfile",
+    "procfile",
+    "jenkinsfile",
+    "makefile",
+    ".gitlab-ci.yml",
+    "docker-compose.yml",
+    "docker-compose.yaml",
+    "compose.yml",
+    "compose.yaml",
+}
+DEPLOYMENT_EXTENSIONS = {".tf", ".tfvars", ".hcl"}
+DEPLOYMENT_DIRS = {"deploy", "deployment", "k8s", "kubernetes", "helm", "workflows"}
+TESTING_DIRS = {"test", "tests", "__tests__", "spec", "specs", "e2e"}
+TESTING_NAME_PATTERN = re.compile(
+    r"^(test_.+|.+_test|.+\.(test|spec)|conftest)\.[^.]+$", re.IGNORECASE
+)
+UI_EXTENSIONS = {".html", ".css", ".scss", ".sass", ".less", ".jsx", ".tsx", ".vue"}
+DB_EXTENSIONS = {".sql"}
+
+# definitions of functions, classes, methods... telling code with logic from data
+LOGIC_PATTERN = re.compile(
+    r"^\s*(export\s+)?(async\s+)?(def|class|function|func|fn|impl|interface)\b"
+    r"|=>|\)\s*\{",
+    re.MULTILINE,
+)
+CONTENT_PATTERNS = {
+    "db_related": re.compile(
+        r"\b(sqlalchemy|sqlite3?|psycopg2?|pymongo|mongoose|prisma|sequelize|typeorm"
+        r"|create\s+table|insert\s+into|select\s+[\w*, ]+\s+from)\b",
+        re.IGNORECASE,
+    ),
+    "ui_related": re.compile(
+        r"\b(streamlit|react|vue|svelte|angular|tkinter|pyqt\d?|jinja2?|classname)\b",
+        re.IGNORECASE,
+    ),
+    "api_related": re.compile(
+        r"\b(fastapi|flask|django|express|apirouter|axios|httpx|graphql|openapi)\b"
+        r"|@(app|router)\.(get|post|put|patch|delete|route)\b",
+        re.IGNORECASE,
+    ),
+    "security_related": re.compile(
+        r"\b(auth\w*|jwt|oauth2?|passwords?|bcrypt|crypto\w*|csrf|permissions?)\b",
+        re.IGNORECASE,
+    ),
+}
+CONTENT_SCAN_SIZE = 64 * 1024
+
+# confidence of the usage inferred for each kind of file, code files staying below
+# the default MIN_USAGE_CONFIDENCE of metadata.py since their relation to
+# databases, UIs, APIs or security is only guessed from keywords
+DATA_CONFIDENCE = 0.95
+CODE_CONFIDENCE = 0.7
+CODE_WITHOUT_LOGIC_CONFIDENCE = 0.5
+
+
+def classify_file_usage(file_path: str, content: str) -> Tuple[Dict[str, bool], float]:
+    """Infer the usage of a file from its path, extension and content.
+
+    Returns the FileUsage fields and a confidence between 0 and 1, which is 0 for
+    files of unknown types and lower for code files, whose relation to databases,
+    UIs, APIs or security is only guessed from keywords.
+    """
+    name = os.path.basename(file_path).lower()
+    extension = get_extension(file_path)
+    dirs = set(file_path.lower().split("/")[:-1])
+    content = content[:CONTENT_SCAN_SIZE]
+    is_code = extension in CODE_EXTENSIONS
+    is_deployment = (
+        name in DEPLOYMENT_NAMES
+        or name.startswith("dockerfile")
+        or extension in DEPLOYMENT_EXTENSIONS
+        or bool(dirs & DEPLOYMENT_DIRS)
+    )
+    is_config = (
+        name in CONFIG_NAMES
+        or extension in CONFIG_EXTENSIONS
+        or (name.startswith(".") and not extension)
+        or any(dir_name.startswith(".") for dir_name in dirs)
+    )
+    usage = {
+        "is_code": is_code,
+        "db_related": extension in DB_EXTENSIONS,
+        "ui_related": extension in UI_EXTENSIONS,
+        "api_related": False,
+        "config_related": is_config,
+        "testing_related": bool(
+            dirs & TESTING_DIRS or TESTING_NAME_PATTERN.match(name)
+        ),
+        "security_related": False,
+        "deployment_related": is_deployment,
+    }
+    if is_code:
+        for field, pattern in CONTENT_PATTERNS.items():
+            usage[field] = usage[field] or bool(pattern.search(content))
+        has_logic = bool(LOGIC_PATTERN.search(content))
+        usage["is_code"] = has_logic
+        return usage, CODE_CONFIDENCE if has_logic else CODE_WITHOUT_LOGIC_CONFIDENCE
+    if is_config or is_deployment or extension in DATA_EXTENSIONS:
+        return usage, DATA_CONFIDENCE
+    return usage, 0.0
@@ -0,0 +1,237 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, FrozenSet, List, Optional
+
+from codeas.core.patterns import (
+    IgnoreRule,
+    is_ignored,
+    parse_ignore_file,
+    parse_ignore_rule,
+)
+from codeas.core.tokens_cache import FileStat
+
+IGNORE_FILES = (".gitignore", ".codeasignore")
+
+
+def walk_files(
+    repo_path: str,
+    exclude_patterns: List[str] = [],
+    include_hidden: bool = False,
+    dirs_paths: Optional[List[str]] = None,
+    progress_callback: Optional[Callable[[int], None]] = None,
+) -> Dict[str, FileStat]:
+    """Return the relative paths of the repository files with their stats.
+
+    Directories matched by the .gitignore/.codeasignore files found along the way
+    or by the exclude patterns (gitignore syntax) are pruned without being entered.
+    Hidden entries are skipped unless include_hidden is set, as glob("**") does.
+    The relative paths of the walked directories are added to dirs_paths if given
+    and progress_callback is called with the number of files found after each one.
+    """
+    files = {}
+    _walk_dir(
+        repo_path,
+        "",
+        _load_root_rules(repo_path),
+        _load_exclude_rules(exclude_patterns),
+        include_hidden,
+        files,
+        dirs_paths,
+        progress_callback,
+    )
+    return files
+
+
+def walk_dir_files(
+    repo_path: str,
+    rel_dir_path: str,
+    exclude_patterns: List[str] = [],
+    include_hidden: bool = False,
+    dirs_paths: Optional[List[str]] = None,
+) -> Dict[str, FileStat]:
+    """Walk a directory of the repository as walk_files would walk it.
+
+    The directory itself isn't checked against the ignore rules, only the
+    entries within it, starting with the rules of its parent directories.
+    """
+    files = {}
+    rel_dir_path = rel_dir_path.replace(os.sep, "/")
+    _walk_dir(
+        os.path.join(repo_path, rel_dir_path),
+        rel_dir_path,
+        _load_parents_rules(repo_path, rel_dir_path),
+        _load_exclude_rules(exclude_patterns),
+        include_hidden,
+        files,
+        dirs_paths,
+        None,
+    )
+    return files
+
+
+def walk_shards_files(
+    repo_path: str,
+    shards: List[str],
+    exclude_patterns: List[str] = [],
+    include_hidden: bool = False,
+    max_workers: Optional[int] = None,
+) -> Dict[str, FileStat]:
+    """Walk the shards of a repository in parallel, as walk_files would walk it.
+
+    Each shard prunes the shards nested in it and starts with the ignore rules
+    of its parent directories, so the files found are the same as walk_files.
+    Shards ignored themselves are not walked.
+    """
+    shards = [
+        shard
+        for shard in shards
+        if not shard
+        or not is_path_ignored(
+            repo_path, shard, exclude_patterns, include_hidden, is_dir=True
+        )
+    ]
+    shards_dirs = frozenset(shard for shard in shards if shard)
+    exclude_rules = _load_exclude_rules(exclude_patterns)
+
+    def walk_shard(shard: str) -> Dict[str, FileStat]:
+        files = {}
+        rel_dir_path = shard.replace(os.sep, "/")
+        _walk_dir(
+            os.path.join(repo_path, shard),
+            rel_dir_path,
+            _load_parents_rules(repo_path, rel_dir_path),
+            exclude_rules,
+            include_hidden,
+            files,
+            None,
+            None,
+            shards_dirs - {rel_dir_path},
+        )
+        return files
+
+    files = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for shard_files in executor.map(walk_shard, shards):
+            files.update(shard_files)
+    return dict(sorted(files.items()))
+
+
+def is_path_ignored(
+    repo_path: str,
+    rel_path: str,
+    exclude_patterns: List[str] = [],
+    include_hidden: bool = False,
+    is_dir: bool = False,
+) -> bool:
+    """Check a single path against the rules walk_files applies along its parents."""
+    parts = rel_path.replace(os.sep, "/").split("/")
+    if not include_hidden and any(part.startswith(".") for part in parts):
+        return True
+    rules = _load_root_rules(repo_path)
+    exclude_rules = _load_exclude_rules(exclude_patterns)
+    rel_dir_path = ""
+    for i, part in enumerate(parts):
+        rules = rules + _load_dir_rules(
+            os.path.join(repo_path, rel_dir_path), rel_dir_path
+        )
+        rel_path = f"{rel_dir_path}/{part}" if rel_dir_path else part
+        part_is_dir = is_dir or i < len(parts) - 1
+        if is_ignored(exclude_rules, rel_path, part_is_dir) or is_ignored(
+            rules, rel_path, part_is_dir
+        ):
+            return True
+        rel_dir_path = rel_path
+    return False
+
+
+def _load_root_rules(repo_path: str) -> List[IgnoreRule]:
+    return parse_ignore_file(os.path.join(repo_path, ".git", "info", "exclude"))
+
+
+def _load_parents_rules(repo_path: str, rel_dir_path: str) -> List[IgnoreRule]:
+    """Load the rules applying to a directory from the ignore files of its parents."""
+    rules = _load_root_rules(repo_path)
+    parts = rel_dir_path.split("/") if rel_dir_path else []
+    for i in range(len(parts)):
+        parent_path = "/".join(parts[:i])
+        rules += _load_dir_rules(os.path.join(repo_path, parent_path), parent_path)
+    return rules
+
+
+def _load_exclude_rules(exclude_patterns: List[str]) -> List[IgnoreRule]:
+    return [
+        rule
+        for rule in (parse_ignore_rule(pattern) for pattern in exclude_patterns)
+        if rule is not None
+    ]
+
+
+def _load_dir_rules(abs_dir_path: str, rel_dir_path: str) -> List[IgnoreRule]:
+    return [
+        rule
+        for ignore_file in IGNORE_FILES
+        for rule in parse_ignore_file(
+            os.path.join(abs_dir_path, ignore_file), rel_dir_path
+        )
+    ]
+
+
+def _walk_dir(
+    abs_dir_path: str,
+    rel_dir_path: str,
+    rules: List[IgnoreRule],
+    exclude_rules: List[IgnoreRule],
+    include_hidden: bool,
+    files: Dict[str, FileStat],
+    dirs_paths: Optional[List[str]],
+    progress_callback: Optional[Callable[[int], None]],
+    skipped_dirs: FrozenSet[str] = frozenset(),
+):
+    dir_rules = _load_dir_rules(abs_dir_path, rel_dir_path)
+    # rules of nested ignore files come last so they take precedence
+    rules = rules + dir_rules if dir_rules else rules
+    try:
+        with os.scandir(abs_dir_path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError:
+        return
+    if dirs_paths is not None:
+        dirs_paths.append(_to_os_path(rel_dir_path))
+
+    for entry in entries:
+        if not include_hidden and entry.name.startswith("."):
+            continue
+        rel_path = f"{rel_dir_path}/{entry.name}" if rel_dir_path else entry.name
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if not is_dir and not entry.is_file():
+                continue
+            if is_ignored(exclude_rules, rel_path, is_dir) or is_ignored(
+                rules, rel_path, is_dir
+            ):
+                continue
+            if is_dir:
+                if rel_path in skipped_dirs:
+                    continue
+                _walk_dir(
+                    entry.path,
+                    rel_path,
+                    rules,
+                    exclude_rules,
+                    include_hidden,
+                    files,
+                    dirs_paths,
+                    progress_callback,
+                    skipped_dirs,
+                )
+            else:
+                stat = entry.stat()
+                files[_to_os_path(rel_path)] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            continue
+    if progress_callback is not None:
+        progress_callback(len(files))
+
+
+def _to_os_path(rel_path: str) -> str:
+    return rel_path if os.sep == "/" else rel_path.replace("/", os.sep)
@@ -0,0 +1,255 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+from typing import List, Set, Tuple
+
+from codeas.core.walker import (
+    IGNORE_FILES,
+    is_path_ignored,
+    walk_dir_files,
+    walk_files,
+)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+DIR_CHANGE_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+EVENT_HEADER = struct.Struct("iIII")
+# directories codeas writes to itself, at the root or in shards, which must
+# never trigger updates
+WATCH_EXCLUDED_DIRS = (".codeas", ".git")
+
+
+class RepoWatcher:
+    """Collect the files changed in a repository from a background thread.
+
+    Uses inotify when available and falls back to polling the repository stats.
+    Changes are only collected here; the owner of the Repo applies them with
+    pop_changes so that the Repo is never mutated while being read.
+    """
+
+    def __init__(
+        self,
+        repo_path: str,
+        ignore_patterns: List[str] = [],
+        include_hidden: bool = False,
+        poll_interval: float = 2.0,
+    ):
+        self.repo_path = repo_path
+        self.ignore_patterns = ignore_patterns
+        self.include_hidden = include_hidden
+        self.poll_interval = poll_interval
+        self.backend = None
+        self._changes: Set[str] = set()
+        self._rescan = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def pop_changes(self) -> Tuple[Set[str], bool]:
+        """Return the changed files and whether a full rescan is needed.
+
+        Directories added or removed are returned along with the files added in
+        them, see Repo.update_files.
+        """
+        with self._lock:
+            changes, rescan = self._changes, self._rescan
+            self._changes, self._rescan = set(), False
+        return changes, rescan
+
+    def _report(self, files_paths: Set[str] = (), rescan: bool = False):
+        with self._lock:
+            self._changes.update(files_paths)
+            self._rescan = self._rescan or rescan
+
+    def _run(self):
+        try:
+            inotify = _Inotify()
+        except OSError as e:
+            logging.info("inotify not available (%s), polling for changes", e)
+            self.backend = "polling"
+            self._run_polling()
+            return
+        self.backend = "inotify"
+        try:
+            self._run_inotify(inotify)
+        finally:
+            inotify.close()
+
+    def _run_inotify(self, inotify: "_Inotify"):
+        watches = {}
+        self._add_watches(inotify, watches)
+        while not self._stop.is_set():
+            events = inotify.read_events(timeout=0.5)
+            changes, rescan = set(), False
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+                if mask & IN_IGNORED:
+                    watches.pop(wd, None)
+                    continue
+                if wd not in watches:
+                    continue
+                rel_dir_path = watches[wd]
+                rel_path = os.path.join(rel_dir_path, name)
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # subdirectories are handled by the events of their parent
+                    rescan = rescan or not rel_dir_path
+                elif mask & IN_ISDIR:
+                    if not mask & DIR_CHANGE_MASK or self._is_dir_ignored(rel_path):
+                        continue
+                    # only the subtree of the directory is watched again and
+                    # walked for its files, its path dropping its removed files
+                    self._remove_watches(inotify, watches, rel_path)
+                    changes.add(rel_path)
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        changes.update(self._add_watches(inotify, watches, rel_path))
+                elif name in IGNORE_FILES:
+                    rescan = True
+                elif name and (self.include_hidden or not name.startswith(".")):
+                    changes.add(rel_path)
+            if rescan:
+                self._reset_watches(inotify, watches)
+            if changes or rescan:
+                self._report(changes, rescan)
+
+    def _is_dir_ignored(self, rel_dir_path: str) -> bool:
+        return any(
+            part in WATCH_EXCLUDED_DIRS for part in rel_dir_path.split(os.sep)
+        ) or is_path_ignored(
+            self.repo_path,
+            rel_dir_path,
+            self.ignore_patterns,
+            self.include_hidden,
+            is_dir=True,
+        )
+
+    def _add_watches(
+        self, inotify: "_Inotify", watches: dict, rel_dir_path: str = ""
+    ) -> Set[str]:
+        """Watch the directories of a subtree, returning the files found in it."""
+        dirs_paths = []
+        files = walk_dir_files(
+            self.repo_path,
+            rel_dir_path,
+            self.ignore_patterns,
+            self.include_hidden,
+            dirs_paths,
+        )
+        for dir_path in dirs_paths:
+            if any(part in WATCH_EXCLUDED_DIRS for part in dir_path.split(os.sep)):
+                continue
+            wd = inotify.add_watch(os.path.join(self.repo_path, dir_path))
+            if wd >= 0:
+                watches[wd] = dir_path
+        return set(files)
+
+    def _remove_watches(self, inotify: "_Inotify", watches: dict, rel_dir_path: str):
+        """Stop watching the directories of a subtree."""
+        for wd, dir_path in list(watches.items()):
+            if dir_path == rel_dir_path or dir_path.startswith(rel_dir_path + os.sep):
+                inotify.rm_watch(wd)
+                del watches[wd]
+
+    def _reset_watches(self, inotify: "_Inotify", watches: dict):
+        """Watch the directories of the whole repository again."""
+        previous_watches = dict(watches)
+        watches.clear()
+        self._add_watches(inotify, watches)
+        for wd in previous_watches.keys() - watches.keys():
+            inotify.rm_watch(wd)
+
+    def _run_polling(self):
+        previous = self._walk_stats()
+        while not self._stop.wait(self.poll_interval):
+            current = self._walk_stats()
+            changes = {
+                file_path
+                for file_path in previous.keys() | current.keys()
+                if previous.get(file_path) != current.get(file_path)
+            }
+            if changes:
+                self._report(changes)
+            previous = current
+
+    def _walk_stats(self) -> dict:
+        return walk_files(self.repo_path, self.ignore_patterns, self.include_hidden)
+
+
+class _Inotify:
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not hasattr(os, "O_CLOEXEC") or libc_name is None:
+            raise OSError("unsupported platform")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("unsupported platform")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            logging.warning("Could not watch %s (errno %s)", path, ctypes.get_errno())
+        return wd
+
+    def rm_watch(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float) -> List[Tuple[int, int, str]]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -1,14 +1,32 @@
 import streamlit as st
 
+from codeas.core.metadata import (
+    MIN_USAGE_CONFIDENCE,
+    PACK_MAX_TOKENS,
+    MetadataSettings,
+)
 from codeas.core.state import state
 
 
 def display():
-    files_missing_metadata = [
-        f
-        for f in state.repo.included_files_paths
-        if f not in state.repo_metadata.files_usage
-    ]
+    st.checkbox(
+        "Whole repository",
+        key="whole_repo_metadata",
+        help="Generate the metadata of every file, starting with the filtered ones",
+    )
+    if st.session_state.get("whole_repo_metadata"):
+        # files skipped as binary, not utf-8 or too large have no tokens
+        files_paths = [
+            file_path
+            for file_path in state.repo.files_paths
+            if state.repo.get_file_tokens(file_path)
+            and file_path not in state.repo.files_skipped
+        ]
+    else:
+        files_paths = state.repo.included_files_paths
+    files_missing_metadata = state.repo_metadata.get_missing_files_paths(
+        state.repo, files_paths
+    )
     if len(files_missing_metadata) > 0:
         st.warning(f"{len(files_missing_metadata)} files are missing metadata")
         st.dataframe(
@@ -21,25 +39,79 @@ def display():
 
 
 def display_generate_missing_metadata(files_missing_metadata):
+    st.checkbox(
+        "Pack small files",
+        key="pack_small_files",
+        help="Identify the usage of several small files per request",
+    )
+    st.checkbox(
+        "Classify files locally",
+        value=True,
+        key="classify_files_locally",
+        help="Infer the usage of files from their path and content when confident",
+    )
+    st.checkbox(
+        "Combine usage and details",
+        key="combine_details",
+        help="Generate the usage and details of each file in a single request",
+    )
+    st.number_input(
+        "Cost budget ($)",
+        min_value=0.0,
+        step=0.5,
+        key="metadata_max_cost",
+        help="Stop sending files once this cost would be exceeded, 0 for no limit",
+    )
     if st.button("Generate Missing Metadata", type="primary"):
+        progress_bar = st.progress(0.0, text="Generating missing metadata...")
+
+        def display_progress(done: int, total: int):
+            progress_bar.progress(
+                done / total, text=f"Generating metadata: {done:,}/{total:,} files"
+            )
+
         with st.spinner("Generating missing metadata..."):
             state.repo_metadata.generate_missing_repo_metadata(
-                state.llm_client, state.repo, files_missing_metadata
+                state.llm_client,
+                state.repo,
+                files_missing_metadata,
+                settings=get_metadata_settings(display_progress),
             )
-            state.repo_metadata.export_metadata(state.repo_path)
+            state.repo_metadata.export_metadata(state.repo_path, state.repo.shards)
+        progress_bar.empty()
         st.success("Missing metadata generated and exported successfully!")
         st.rerun()
 
     if st.button("Estimate cost", key="estimate_missing_metadata"):
         with st.spinner("Estimating cost..."):
             preview = state.repo_metadata.generate_missing_repo_metadata(
-                state.llm_client, state.repo, files_missing_metadata, preview=True
+                state.llm_client,
+                state.repo,
+                files_missing_metadata,
+                preview=True,
+                settings=get_metadata_settings(),
             )
-            input_cost = preview.cost["input_cost"]
-            input_tokens = preview.tokens["input_tokens"]
-            estimated_cost = input_cost * 3
-            estimated_input_tokens = input_tokens * 2
-            estimated_output_tokens = input_tokens // 3
             st.caption(
-                f"Estimated cost: ${estimated_cost:.4f} (input tokens: {estimated_input_tokens:,} + output tokens: {estimated_output_tokens:,})"
+                f"Estimated cost: ${preview.cost['total_cost']:.4f} (input tokens: {preview.tokens['input_tokens']:,} + output tokens: {preview.tokens['output_tokens']:,})"
             )
+            if len(preview.files_paths) < len(files_missing_metadata):
+                st.caption(
+                    f"{len(preview.files_paths):,}/{len(files_missing_metadata):,} files within the cost budget"
+                )
+
+
+def get_metadata_settings(progress_callback=None) -> MetadataSettings:
+    return MetadataSettings(
+        pack_max_tokens=(
+            PACK_MAX_TOKENS if st.session_state.get("pack_small_files") else None
+        ),
+        combine_details=st.session_state.get("combine_details", False),
+        min_usage_confidence=(
+            MIN_USAGE_CONFIDENCE
+            if st.session_state.get("classify_files_locally", True)
+            else None
+        ),
+        priority_files_paths=state.repo.included_files_paths,
+        max_cost=st.session_state.get("metadata_max_cost") or None,
+        progress_callback=progress_callback,
+    )
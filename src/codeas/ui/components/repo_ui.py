@@ -12,26 +12,90 @@ def display():
 
 
 def display_repo_path():
-    st.markdown(f"**Repo**: {os.path.abspath(state.repo_path)}")
+    col_path, col_watch = st.columns([4, 1])
+    with col_path:
+        st.markdown(f"**Repo**: {os.path.abspath(state.repo_path)}")
+    with col_watch:
+        st.toggle(
+            "Watch files",
+            value=state.repo_watcher is not None,
+            key="watch_files",
+            on_change=update_repo_watcher,
+            help="Keep the files and their tokens in sync with changes on disk",
+        )
+    display_scan_settings()
+    if not state.is_repo_loaded:
+        load_repo()
+
+
+def display_scan_settings():
+    with st.expander("Scan settings"):
+        tokens_modes = ["auto", "exact", "estimate"]
+        st.selectbox(
+            "Tokens",
+            tokens_modes,
+            index=tokens_modes.index(state.tokens_mode),
+            key="tokens_mode",
+            on_change=update_scan_settings,
+            help="Count the tokens of every file, or estimate them from their size "
+            "while counting them in the background. Auto estimates them for large "
+            "repositories only.",
+        )
+        st.toggle(
+            "Detect sub-projects",
+            value=state.detect_shards,
+            key="detect_shards",
+            on_change=update_scan_settings,
+            help="Split monorepos into the sub-projects found in them",
+        )
+
+
+def update_scan_settings():
+    state.update_repo_settings(
+        st.session_state["tokens_mode"], st.session_state["detect_shards"]
+    )
+
+
+def load_repo():
+    progress_bar = st.progress(0.0, text="Scanning repository...")
+
+    def display_progress(stage: str, done: int, total: int):
+        if total:
+            progress_bar.progress(
+                done / total, text=f"{stage.capitalize()} files: {done:,}/{total:,}"
+            )
+        else:
+            progress_bar.progress(0.0, text=f"{stage.capitalize()} files: {done:,}")
+
+    state.load_repo(display_progress)
+    progress_bar.empty()
+
+
+def update_repo_watcher():
+    if st.session_state["watch_files"]:
+        state.start_repo_watcher()
+    else:
+        state.stop_repo_watcher()
 
 
 def display_files():
     display_filters()
     num_selected_files, total_files, selected_tokens = get_selected_files_info()
+    approx = "~" if state.repo.is_estimating else ""
     with st.expander(
-        f"{num_selected_files}/{total_files} files selected | {selected_tokens:,} tokens"
+        f"{num_selected_files}/{total_files} files selected | {approx}{selected_tokens:,} tokens"
     ):
+        if state.repo.is_estimating:
+            st.caption(
+                "Tokens of files with status 'estimated' are provisional while they are being counted."
+            )
         display_files_editor()
 
 
 def get_selected_files_info():
-    num_selected_files = sum(state.files_data["Incl."])
-    total_files = len(state.files_data["Incl."])
-    selected_tokens = sum(
-        token
-        for incl, token in zip(state.files_data["Incl."], state.files_data["Tokens"])
-        if incl
-    )
+    num_selected_files = len(state.repo.included_files_paths)
+    total_files = len(state.repo.files_paths)
+    selected_tokens = sum(state.repo.included_files_tokens)
     return num_selected_files, total_files, selected_tokens
 
 
@@ -54,16 +118,27 @@ def display_filters():
             on_change=lambda: update_filter("exclude"),
             placeholder="Example: debug/*, *.ipynb, etc.",
         )
+    if len(state.repo.shards) > 1:
+        st.multiselect(
+            "Projects",
+            options=state.repo.shards,
+            default=[
+                shard for shard in page_filter.shards if shard in state.repo.shards
+            ],
+            format_func=lambda shard: shard or "(root)",
+            key="shards_input",
+            on_change=lambda: update_filter("shards"),
+            placeholder="All projects",
+        )
 
 
-def update_filter(filter_type: Literal["include", "exclude"]):
+def update_filter(filter_type: Literal["include", "exclude", "shards"]):
     input_key = f"{filter_type}_input"
     update_args = {filter_type: st.session_state[input_key]}
     state.update_page_filter(**update_args)
 
 
 def display_files_editor():
-    sort_files_data()
     st.data_editor(
         state.files_data,
         use_container_width=True,
@@ -71,6 +146,7 @@ def display_files_editor():
             "Incl.": st.column_config.CheckboxColumn(width=5),
             "Path": st.column_config.TextColumn(width="large"),
             "Tokens": st.column_config.NumberColumn(width=5),
+            "Status": st.column_config.TextColumn(width="small"),
         },
         disabled=True,
         height=300,
@@ -92,22 +168,6 @@ def display_metadata_editor(files_metadata):
     )
 
 
-def sort_files_data():
-    sorted_data = sorted(
-        zip(
-            state.files_data["Incl."],
-            state.files_data["Path"],
-            state.files_data["Tokens"],
-        ),
-        key=lambda x: (not x[0], x[1]),
-    )
-    (
-        state.files_data["Incl."],
-        state.files_data["Path"],
-        state.files_data["Tokens"],
-    ) = zip(*sorted_data)
-
-
 def sort_files_metadata(files_metadata):
     sorted_data = sorted(
         zip(
@@ -2,11 +2,11 @@ import uuid
 
 import streamlit as st
 import streamlit_nested_layout  # noqa
-import tokencost
 
 from codeas.core.clients import MODELS, LLMClients
 from codeas.core.retriever import ContextRetriever
 from codeas.core.state import state
+from codeas.core.tokenizers import count_tokens
 from codeas.core.usage_tracker import usage_tracker
 from codeas.ui.components import metadata_ui, repo_ui
 from codeas.ui.utils import read_prompts
@@ -16,6 +16,7 @@ def chat():
     st.subheader("💬 Chat")
     state.update_current_page("Chat")
     repo_ui.display_repo_path()
+    state.update_tokens_model(st.session_state.get("model1") or "gpt-4o")
     display_config_section()
 
     if "chat_history" not in st.session_state:
@@ -351,10 +352,7 @@ def run_agent(model):
     llm_client = LLMClients(model=model)
     messages = get_history_messages(model)
     if model == "claude-3-5-sonnet" or model == "claude-3-haiku":
-        if (
-            tokencost.count_string_tokens(llm_client.extract_strings(messages), model)
-            > 10000
-        ):
+        if count_tokens(llm_client.extract_strings(messages), model) > 10000:
             st.warning(
                 "Anthropic API is limited to 80k tokens per minute. Using it with large context may result in errors."
             )
@@ -400,6 +398,7 @@ def get_retriever_args():
         "include_api_files": file_types == "API files",
         "use_descriptions": content_types == "Descriptions",
         "use_details": content_types == "Details",
+        "tokens_model": st.session_state.get("model1") or "gpt-4o",
     }
 
 